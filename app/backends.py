@@ -0,0 +1,264 @@
+"""
+backends.py – selectable CPU inference backends for InceptionResnetV1 and the MTCNN stages
+
+eager        the PyTorch module itself, run without autograd
+torchscript  traced and frozen TorchScript graph
+int8         dynamic int8 quantization (nn.Linear layers; convolutions stay fp32)
+onnx         ONNX Runtime session over an exported graph (needs onnxruntime)
+
+Every non-eager backend is compared with the eager module when it is built, and the
+eager module is used instead if they differ by more than the tolerance. Embedders are
+checked on face-like crops: the cosine distance between their embeddings must stay a
+small fraction of the match threshold. MTCNN stages are checked on fixed random input.
+"""
+import os
+import inspect
+import numpy as np
+import torch
+
+BACKENDS = ["eager", "torchscript", "int8", "onnx"]
+
+# max abs difference allowed against eager on the raw MTCNN stage outputs
+TOLERANCE = {"torchscript": 1e-4, "int8": 5e-2, "onnx": 1e-3}
+# share of the match threshold an embedder backend may move an embedding away from eager
+EMBEDDING_DRIFT = 0.05
+
+try:
+    import onnxruntime
+    onnx_available = True
+except ImportError:
+    onnx_available = False
+
+
+class EagerModule(torch.nn.Module):
+    """Runs a module without autograd bookkeeping."""
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        with torch.no_grad():
+            return self.module(x)
+
+
+class BackendModule(torch.nn.Module):
+    """Base for wrappers whose graph has no visible parameters.
+
+    MTCNN reads the input dtype from next(pnet.parameters()), so a placeholder is kept.
+    """
+    def __init__(self):
+        super().__init__()
+        self.dtype_hint = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+
+
+class TorchScriptModule(BackendModule):
+    """Traced and frozen TorchScript graph of a module."""
+    def __init__(self, graph):
+        super().__init__()
+        self.graph = graph
+
+    @classmethod
+    def trace(cls, module, example):
+        with torch.no_grad():
+            return cls(torch.jit.freeze(torch.jit.trace(module, example, check_trace=False)))
+
+    @classmethod
+    def load(cls, path, device):
+        return cls(torch.jit.load(path, map_location=device))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        torch.jit.save(self.graph, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def forward(self, x):
+        with torch.no_grad():
+            return self.graph(x)
+
+
+class OnnxModule(BackendModule):
+    """Callable stand-in for a module, backed by an ONNX Runtime CPU session."""
+    def __init__(self, path, threads=0):
+        super().__init__()
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})
+        outputs = tuple(torch.from_numpy(o).to(x.device) for o in outputs)
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def build(kind, module, example, name, cache_dir="models", threads=0, compare=None, tolerance=None):
+    """Wrap `module` (in eval mode) in the requested backend, falling back to eager on failure or drift.
+
+    `compare(eager, candidate, example)` measures the drift (parity by default) and
+    `tolerance` bounds it (TOLERANCE[kind] by default).
+    """
+    compare = compare or parity
+    module = module.eval()
+    eager = EagerModule(module)
+    if kind == "eager":
+        return eager
+    try:
+        if kind == "torchscript":
+            candidate = TorchScriptModule.trace(module, example)
+        elif kind == "int8":
+            candidate = EagerModule(torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8))
+        elif kind == "onnx":
+            if not onnx_available:
+                raise RuntimeError("onnxruntime is not installed")
+            candidate = OnnxModule(export_onnx(module, example, os.path.join(cache_dir, name + ".onnx")), threads)
+        else:
+            raise ValueError(f"Unknown backend {kind}, expected one of: " + ", ".join(BACKENDS))
+        error = compare(eager, candidate, example)
+    except Exception as e:
+        print(f"[Backend ERROR] {name}: cannot build {kind} backend, using eager: {e}")
+        return eager
+    limit = TOLERANCE[kind] if tolerance is None else tolerance
+    if error > limit:
+        print(f"[Backend] {name}: {kind} differs from eager by {error:.2e} (limit {limit:.2e}), using eager")
+        if kind == "onnx":
+            os.remove(os.path.join(cache_dir, name + ".onnx"))
+        return eager
+    print(f"[Backend] {name}: using {kind} (diff {error:.2e}, limit {limit:.2e})")
+    return candidate
+
+
+def export_onnx(module, example, path):
+    """Export once to `path` with dynamic batch and spatial axes; reuse the file afterwards."""
+    if os.path.isfile(path):
+        return path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with torch.no_grad():
+        outputs = module(example)
+    count = len(outputs) if isinstance(outputs, tuple) else 1
+    names = [f"output{i}" for i in range(count)]
+    axes = {"input": {0: "batch", 2: "height", 3: "width"}}
+    axes.update({n: {0: "batch"} for n in names})
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    # several worker processes may export at once; only complete files get the final name
+    tmp = f"{path}.{os.getpid()}.tmp"
+    torch.onnx.export(module, (example,), tmp, input_names=["input"], output_names=names,
+                      dynamic_axes=axes, opset_version=13, **kwargs)
+    os.replace(tmp, path)
+    return path
+
+
+def parity(reference, candidate, example):
+    """Largest absolute difference between two modules' outputs on `example`."""
+    with torch.no_grad():
+        expected, actual = reference(example), candidate(example)
+    if not isinstance(expected, tuple):
+        expected, actual = (expected,), (actual,)
+    return max(float((e.float() - a.float()).abs().max()) for e, a in zip(expected, actual))
+
+
+def embedding_drift(reference, candidate, crops):
+    """Largest cosine distance between two embedders' (L2-normalized) embeddings of the same crops."""
+    with torch.no_grad():
+        expected, actual = reference(crops).float(), candidate(crops).float()
+    return float((1 - torch.nn.functional.cosine_similarity(expected, actual)).max())
+
+
+def drift_limit(threshold):
+    """Cosine distance equal to EMBEDDING_DRIFT of the match threshold.
+
+    The threshold is a Euclidean distance between unit vectors, so d corresponds to
+    a cosine distance of d^2 / 2.
+    """
+    return (EMBEDDING_DRIFT * threshold) ** 2 / 2
+
+
+def face_crops(count=8, size=160, seed=0):
+    """Synthetic face crops standardized like MTCNN output, (x - 127.5) / 128.
+
+    A skin-toned oval with hair, eyes, brows, nose and mouth over a background gradient,
+    varied per crop; much closer to what the embedder sees at the door than random noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+
+    def blob(cx, cy, rx, ry, softness=0.02):
+        # 1 inside the ellipse, fading to 0 over `softness` of the crop
+        d = np.sqrt(((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2)
+        return 1 / (1 + np.exp((d - 1) * min(rx, ry) / softness))
+
+    crops = []
+    for _ in range(count):
+        top, bottom = rng.uniform(40, 220, 3), rng.uniform(40, 220, 3)
+        image = top + (bottom - top) * y[..., None]
+        cx, cy = 0.5 + rng.uniform(-0.04, 0.04), 0.52 + rng.uniform(-0.04, 0.04)
+        skin = np.array([rng.uniform(150, 235), 0, 0])
+        skin[1], skin[2] = skin[0] * rng.uniform(0.7, 0.85), skin[0] * rng.uniform(0.55, 0.75)
+        hair = rng.uniform(10, 90) * np.array([1.0, 0.85, 0.7])
+        layers = [
+            (blob(cx, cy - 0.12, 0.36, 0.3), hair),
+            (blob(cx, cy, 0.3, 0.4), skin),
+        ]
+        for side in (-1, 1):
+            ex = cx + side * 0.12
+            layers += [
+                (blob(ex, cy - 0.12, 0.08, 0.02), hair),
+                (blob(ex, cy - 0.05, 0.06, 0.03), np.array([235.0, 230, 225])),
+                (blob(ex, cy - 0.05, 0.025, 0.025), rng.uniform(20, 90) * np.ones(3)),
+            ]
+        layers += [
+            (blob(cx, cy + 0.08, 0.04, 0.1) * 0.35, skin * 0.6),
+            (blob(cx, cy + 0.2, 0.1, 0.025), skin * np.array([0.75, 0.45, 0.45])),
+        ]
+        for alpha, color in layers:
+            image = image * (1 - alpha[..., None]) + color * alpha[..., None]
+        light = 1 + rng.uniform(-0.25, 0.25) * (x - 0.5)
+        image = image * light[..., None] + rng.normal(0, 3, image.shape)
+        crops.append(np.clip(image, 0, 255).transpose(2, 0, 1))
+    return (torch.from_numpy(np.stack(crops)).float() - 127.5) / 128
+
+
+def build_embedder(kind, model, device, threshold, cache_dir="models", threads=0):
+    """Embedder backend whose embeddings stay within drift_limit(threshold) of eager on face_crops()."""
+    return build(kind, model, face_crops().to(device), "inception_resnet_v1", cache_dir, threads,
+                 compare=embedding_drift, tolerance=drift_limit(threshold))
+
+
+def load_embedder(kind, device, threshold, cache_dir="models", threads=0):
+    """Embedder from the artifact cached by an earlier start if there is one.
+
+    Otherwise InceptionResnetV1 is built from the pretrained weights, and a TorchScript
+    graph or ONNX file is left in cache_dir for the next start. Cached artifacts were
+    parity-checked when they were written.
+    """
+    name = "inception_resnet_v1"
+    script_path = os.path.join(cache_dir, name + ".torchscript.pt")
+    try:
+        if kind == "onnx" and onnx_available and os.path.isfile(os.path.join(cache_dir, name + ".onnx")):
+            return OnnxModule(os.path.join(cache_dir, name + ".onnx"), threads)
+        if kind == "torchscript" and os.path.isfile(script_path):
+            return TorchScriptModule.load(script_path, device)
+    except Exception as e:
+        print(f"[Backend ERROR] {name}: cannot load cached {kind} artifact, rebuilding: {e}")
+    from facenet_pytorch import InceptionResnetV1
+    embedder = build_embedder(kind, InceptionResnetV1(pretrained='vggface2').eval().to(device), device,
+                              threshold, cache_dir, threads)
+    if isinstance(embedder, TorchScriptModule):
+        embedder.save(script_path)
+    return embedder
+
+
+def build_mtcnn(kind, mtcnn, cache_dir="models", threads=0):
+    """Swap the P/R/O-net stages of a facenet_pytorch MTCNN for the requested backend, in place."""
+    generator = torch.Generator().manual_seed(0)
+    examples = {
+        "pnet": torch.randn(1, 3, 120, 68, generator=generator),
+        "rnet": torch.randn(4, 3, 24, 24, generator=generator),
+        "onet": torch.randn(4, 3, 48, 48, generator=generator),
+    }
+    for stage, example in examples.items():
+        module = getattr(mtcnn, stage)
+        if isinstance(module, (EagerModule, BackendModule)):
+            continue
+        setattr(mtcnn, stage, build(kind, module, example.to(mtcnn.device), "mtcnn_" + stage, cache_dir, threads))
+    return mtcnn
@@ -1,102 +1,398 @@
 import sqlite3
 import pickle
+import io
+import threading
+import numpy as np
+from collections import OrderedDict
 from datetime import datetime
+from PIL import Image
 from PyQt5.QtCore import QObject, pyqtSignal
 from messages import Message, MessageContainer
 import time
 import os
+from contextlib import contextmanager
 
 
 class Person:
-    def __init__(self, id=-1, cardId="", name="Unknown", img=None, date=datetime.now()):
+    def __init__(self, id=-1, cardId="", name="Unknown", img=None, date=datetime.now(),
+                 embedding=None, embedding_model=None, image_loader=None):
         self.id = id
         self.cardId = cardId
         self.name = name
         self.img = img
         self.date = date
+        self.embedding = embedding
+        self.embedding_model = embedding_model
+        self._image_loader = image_loader
+
+    @property
+    def img(self):
+        """Photo of the person, fetched from the database on first access."""
+        if self._img is None and self._image_loader is not None:
+            return self._image_loader(self.id)
+        return self._img
+
+    @img.setter
+    def img(self, value):
+        self._img = value
 
     def __eq__(self, other):
         return self.id == other.id
 
 
+JPEG_MAGIC = b"\xff\xd8\xff"
+JPEG_QUALITY = 90
+
+
+def encode_image(img):
+    """Photo (PIL image, RGB array or already encoded JPEG bytes) as JPEG bytes."""
+    if isinstance(img, (bytes, bytearray)):
+        return bytes(img)
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def decode_image(blob):
+    img = Image.open(io.BytesIO(blob))
+    img.load()
+    return img
+
+
+def _create_persons(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS persons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cardId TEXT NOT NULL,
+        name TEXT NOT NULL,
+        image BLOB NOT NULL,
+        registered_date TEXT
+    )''')
+
+
+def _add_embedding_columns(connection):
+    # Databases created before embeddings were stored lack these columns;
+    # the recognizer backfills them once on its first start.
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(persons)")]
+    if "embedding" not in columns:
+        connection.execute("ALTER TABLE persons ADD COLUMN embedding BLOB")
+    if "embedding_model" not in columns:
+        connection.execute("ALTER TABLE persons ADD COLUMN embedding_model TEXT")
+
+
+def _index_card_ids(connection):
+    connection.execute("CREATE INDEX IF NOT EXISTS persons_cardId ON persons (cardId)")
+
+
+def _photos_to_jpeg(connection):
+    # Photos used to be pickled PIL images; unpickling is acceptable once here, for rows
+    # this application wrote itself, and never again afterwards.
+    rows = connection.execute("SELECT id, image FROM persons").fetchall()
+    for id, blob in rows:
+        if blob[:3] == JPEG_MAGIC:
+            continue
+        connection.execute("UPDATE persons SET image = ? WHERE id = ?", (encode_image(pickle.loads(blob)), id))
+
+
+def _unique_card_ids(connection):
+    # One card opens the door for one person; the constraint also settles concurrent enrollments
+    duplicates = connection.execute(
+        "SELECT cardId FROM persons GROUP BY cardId HAVING COUNT(*) > 1").fetchall()
+    if duplicates:
+        raise RuntimeError("Cards enrolled for more than one person: " + ", ".join(c for (c,) in duplicates)
+                           + "; remove the extra persons and start again")
+    connection.execute("DROP INDEX IF EXISTS persons_cardId")
+    connection.execute("CREATE UNIQUE INDEX persons_cardId ON persons (cardId)")
+
+
+# Schema history; PRAGMA user_version holds the number of steps already applied.
+# Steps must be safe on databases that were created before versioning existed.
+MIGRATIONS = [
+    _create_persons,
+    _add_embedding_columns,
+    _index_card_ids,
+    _photos_to_jpeg,
+    _unique_card_ids,
+]
+
+
 class SQLiteDatabase(QObject):
+    """Persons table with an in-memory metadata cache.
+
+    Every thread gets its own connection. The database runs in WAL mode, so the
+    recognition and GUI threads keep reading while an enrollment is written.
+    """
     databaseChanged = pyqtSignal()
+    personAdded = pyqtSignal(int)
+    personRemoved = pyqtSignal(int)
 
-    def __init__(self, database_path):
+    def __init__(self, database_path, image_cache_size=32):
         super().__init__()
         self.db_path = database_path
         self.messages = MessageContainer()
-        self.sqlite_connection = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.cursor = self.sqlite_connection.cursor()
-        self._ensure_schema()
-
-    def _ensure_schema(self):
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS persons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            cardId TEXT NOT NULL,
-            name TEXT NOT NULL,
-            image BLOB NOT NULL,
-            registered_date TEXT
-        )''')
-        self.sqlite_connection.commit()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._migrate()
+
+        # Metadata of every person is kept in memory so recognition never has to
+        # query SQLite or decode images; photos are loaded on demand into a small LRU.
+        self._cache_lock = threading.Lock()
+        self._persons = {}
+        self._card_ids = {}
+        self._images = OrderedDict()
+        self.image_cache_size = image_cache_size
+        self._load_cache()
+
+    @property
+    def connection(self):
+        """The calling thread's connection, opened on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # used by this thread only; check_same_thread=False just lets close() run from another one
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # with WAL, NORMAL is still crash-safe; only the last commits may be lost on power failure
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements as one transaction on the calling thread's connection."""
+        connection = self.connection
+        with connection:
+            yield connection
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    @property
+    def schema_version(self):
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate(self):
+        version = self.schema_version
+        for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            with self.transaction() as connection:
+                # explicit BEGIN: sqlite3 would otherwise autocommit the DDL statement by statement
+                connection.execute("BEGIN")
+                step(connection)
+                connection.execute(f"PRAGMA user_version = {number}")
+            print(f"[DB] Migrated schema to version {number} ({step.__name__.strip('_')})")
+
+    def _load_cache(self):
+        try:
+            rows = self.connection.execute("SELECT id, cardId, name, registered_date FROM persons").fetchall()
+        except Exception as e:
+            print(f"[DB ERROR] Failed to load persons: {e}")
+            rows = []
+        with self._cache_lock:
+            self._persons = {id: (card, name, date) for (id, card, name, date) in rows}
+            self._card_ids = {card: id for (id, card, name, date) in rows}
+            self._images.clear()
+
+    def _cache_person(self, id, card, name, date):
+        with self._cache_lock:
+            self._persons[id] = (card, name, date)
+            self._card_ids[card] = id
+
+    def _fetch_person(self, column, value):
+        """Look a person up in SQLite; for rows written by another process (e.g. a bulk import)."""
+        try:
+            row = self.connection.execute(
+                f"SELECT id, cardId, name, registered_date FROM persons WHERE {column} = ?", (value,)).fetchone()
+        except Exception as e:
+            print(f"[DB ERROR] Failed to fetch person: {e}")
+            return None
+        if row is None:
+            return None
+        self._cache_person(*row)
+        return row[0]
+
+    def _cached_person(self, id):
+        with self._cache_lock:
+            entry = self._persons.get(id)
+        if entry is None:
+            return Person()
+        card, name, date = entry
+        return Person(id, card, name, date=date, image_loader=self.get_image)
 
     def get_all(self):
+        with self._cache_lock:
+            ids = sorted(self._persons)
+        return [self._cached_person(id) for id in ids]
+
+    def get_image(self, id):
+        """Return the stored photo of a person, going to SQLite only on an LRU miss."""
+        with self._cache_lock:
+            img = self._images.get(id)
+            if img is not None:
+                self._images.move_to_end(id)
+                return img
         try:
-            self.cursor.execute("SELECT * FROM persons")
-            return [
-                Person(id, card, name, pickle.loads(img), date)
-                for (id, card, name, img, date) in self.cursor.fetchall()
-            ]
+            row = self.connection.execute("SELECT image FROM persons WHERE id = ?", (id,)).fetchone()
+            if not row:
+                return None
+            img = decode_image(row[0])
         except Exception as e:
-            print(f"[DB ERROR] Failed to fetch all persons: {e}")
-            return []
+            print(f"[DB ERROR] Failed to fetch image: {e}")
+            return None
+        with self._cache_lock:
+            self._images[id] = img
+            while len(self._images) > self.image_cache_size:
+                self._images.popitem(last=False)
+        return img
 
     def add_person(self, person: Person):
-        if not all([person.name, person.cardId, person.img]):
+        if self.add_persons([person]):
+            self.messages.put(Message(f"Person {person.name} added", (170, 255, 150), time.time(), 6))
+        else:
+            self.messages.put(Message("Failed to add person", (255, 150, 150), time.time(), 6))
+
+    def add_persons(self, persons):
+        """Insert persons in one transaction; returns how many were added (0 if the batch failed)."""
+        persons = [p for p in persons if p.name and p.cardId and p.img is not None]
+        if not persons:
             print("[DB] Invalid person data")
-            return
+            return 0
 
+        date = str(datetime.now())
         try:
-            binary = pickle.dumps(person.img, -1)
-            self.cursor.execute(
-                '''INSERT INTO persons (cardId, name, image, registered_date)
-                   VALUES (?, ?, ?, ?)''',
-                (person.cardId, person.name, binary, datetime.now())
-            )
-            self.sqlite_connection.commit()
-            self.databaseChanged.emit()
-            self.messages.put(Message(f"Person {person.name} added", (170, 255, 150), time.time(), 6))
+            # encode before the transaction so the write lock is held only for the inserts
+            rows = [(person.cardId, person.name, encode_image(person.img), date,
+                     None if person.embedding is None else np.asarray(person.embedding, np.float32).tobytes(),
+                     None if person.embedding is None else person.embedding_model)
+                    for person in persons]
+            with self.transaction() as connection:
+                for person, row in zip(persons, rows):
+                    cursor = connection.execute(
+                        '''INSERT INTO persons (cardId, name, image, registered_date, embedding, embedding_model)
+                           VALUES (?, ?, ?, ?, ?, ?)''', row)
+                    person.id = cursor.lastrowid
+                    person.date = date
+        except sqlite3.IntegrityError as e:
+            print(f"[DB ERROR] Card already enrolled, persons not added: {e}")
+            return 0
         except Exception as e:
-            print(f"[DB ERROR] Failed to add person: {e}")
-            self.messages.put(Message("Failed to add person", (255, 150, 150), time.time(), 6))
+            print(f"[DB ERROR] Failed to add persons: {e}")
+            return 0
+        for person in persons:
+            self._cache_person(person.id, person.cardId, person.name, person.date)
+            self.personAdded.emit(person.id)
+        self.databaseChanged.emit()
+        return len(persons)
 
     def remove(self, id):
         try:
             person = self.get_person_by_id(id)
-            self.cursor.execute("DELETE FROM persons WHERE id = ?", (id,))
-            self.sqlite_connection.commit()
+            if person.id == -1:
+                print(f"[DB] No person with id {id} to remove")
+                return
+            with self.transaction() as connection:
+                connection.execute("DELETE FROM persons WHERE id = ?", (id,))
+            with self._cache_lock:
+                self._persons.pop(id, None)
+                self._images.pop(id, None)
+                if self._card_ids.get(person.cardId) == id:
+                    del self._card_ids[person.cardId]
+            self.personRemoved.emit(id)
             self.databaseChanged.emit()
             self.messages.put(Message(f"Person {person.name} removed", (255, 130, 150), time.time(), 6))
         except Exception as e:
             print(f"[DB ERROR] Failed to remove person: {e}")
             self.messages.put(Message("Failed to remove person", (255, 150, 150), time.time(), 6))
 
-    def get_person_by_id(self, id):
-        return self._fetch_person_by("id", id)
+    def get_embeddings(self, model):
+        """Return {id: embedding} for every person encoded with the given model."""
+        try:
+            rows = self.connection.execute(
+                "SELECT id, embedding FROM persons WHERE embedding_model = ? AND embedding IS NOT NULL", (model,))
+            return {id: np.frombuffer(blob, dtype=np.float32) for (id, blob) in rows.fetchall()}
+        except Exception as e:
+            print(f"[DB ERROR] Failed to fetch embeddings: {e}")
+            return {}
 
-    def get_person_by_cardid(self, cardId):
-        return self._fetch_person_by("cardId", cardId)
+    def get_embedding_ids(self, model):
+        try:
+            rows = self.connection.execute(
+                "SELECT id FROM persons WHERE embedding_model = ? AND embedding IS NOT NULL", (model,))
+            return [id for (id,) in rows.fetchall()]
+        except Exception as e:
+            print(f"[DB ERROR] Failed to fetch embedding ids: {e}")
+            return []
 
-    def _fetch_person_by(self, field, value):
+    def get_embedding(self, id, model):
         try:
-            self.cursor.execute(f"SELECT * FROM persons WHERE {field} = ?", (value,))
-            row = self.cursor.fetchone()
-            if row:
-                id, cardId, name, img, date = row
-                return Person(id, cardId, name, pickle.loads(img), date)
+            row = self.connection.execute(
+                "SELECT embedding FROM persons WHERE id = ? AND embedding_model = ?", (id, model)).fetchone()
+            if row and row[0] is not None:
+                return np.frombuffer(row[0], dtype=np.float32)
         except Exception as e:
-            print(f"[DB ERROR] Failed to fetch person by {field}: {e}")
-        return Person()
+            print(f"[DB ERROR] Failed to fetch embedding: {e}")
+        return None
+
+    def get_unencoded(self, model):
+        """Return persons not yet encoded by the given model.
+
+        Photos the model already found no face in (see mark_no_face) are not returned again.
+        """
+        try:
+            rows = self.connection.execute(
+                '''SELECT id, cardId, name, image, registered_date FROM persons
+                   WHERE embedding_model IS NOT ?''', (model,))
+            return [
+                Person(id, card, name, decode_image(img), date)
+                for (id, card, name, img, date) in rows.fetchall()
+            ]
+        except Exception as e:
+            print(f"[DB ERROR] Failed to fetch unencoded persons: {e}")
+            return []
+
+    def mark_no_face(self, ids, model):
+        """Record that the model found no face in these persons' photos: a NULL embedding tagged with the model."""
+        try:
+            with self.transaction() as connection:
+                connection.executemany("UPDATE persons SET embedding = NULL, embedding_model = ? WHERE id = ?",
+                                       [(model, id) for id in ids])
+        except Exception as e:
+            print(f"[DB ERROR] Failed to mark persons without a face: {e}")
+
+    def set_embedding(self, id, embedding, model):
+        self.set_embeddings({id: embedding}, model)
+
+    def set_embeddings(self, embeddings, model):
+        """Store {id: embedding} in one transaction."""
+        try:
+            with self.transaction() as connection:
+                connection.executemany(
+                    "UPDATE persons SET embedding = ?, embedding_model = ? WHERE id = ?",
+                    [(np.asarray(e, np.float32).tobytes(), model, id) for id, e in embeddings.items()]
+                )
+        except Exception as e:
+            print(f"[DB ERROR] Failed to store embeddings: {e}")
+
+    def get_person_by_id(self, id):
+        with self._cache_lock:
+            cached = id in self._persons
+        if not cached:
+            self._fetch_person("id", id)
+        return self._cached_person(id)
+
+    def get_person_by_cardid(self, cardId):
+        with self._cache_lock:
+            id = self._card_ids.get(cardId)
+        if id is None:
+            # served by the cardId index
+            id = self._fetch_person("cardId", cardId)
+        return self._cached_person(id)
 
 
 def create_test_db(database_path):
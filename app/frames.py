@@ -0,0 +1,117 @@
+import time
+import threading
+import numpy as np
+
+
+class Frame:
+    """Camera frame together with the faces detected on it, largest face first."""
+    def __init__(self, image, boxes=None, probs=None, landmarks=None, timestamp=None, track_ids=None,
+                 embeddings=None):
+        self.image = image
+        self.boxes = np.zeros((0, 4), np.float32) if boxes is None else np.asarray(boxes, np.float32)
+        self.probs = np.zeros(0, np.float32) if probs is None else np.asarray(probs, np.float32)
+        self.landmarks = np.zeros((0, 5, 2), np.float32) if landmarks is None else np.asarray(landmarks, np.float32)
+        self.timestamp = time.time() if timestamp is None else timestamp
+        # filled in by FaceTracker.update, one id per box
+        self.track_ids = [] if track_ids is None else list(track_ids)
+        # set when an inference worker already embedded the faces, one row per box
+        self.embeddings = embeddings
+        # assigned by FrameBuffer.publish
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @property
+    def has_faces(self):
+        return len(self.boxes) > 0
+
+
+class FrameBuffer:
+    """Latest-frame-wins hand-off between the video thread and its consumers.
+
+    Images are copied into a small pool of preallocated slots, so a consumer never
+    sees a buffer that the producer reuses while it is still reading: a slot handed
+    out by wait_newer stays leased until release. The lock is held only to pick and
+    publish slots, never during the copy.
+    """
+    def __init__(self, slots=3):
+        self._cond = threading.Condition()
+        self._images = [None] * slots
+        self._frames = [None] * slots
+        self._leases = [0] * slots
+        self._latest = None
+        self._seq = 0
+        self._last_read = 0
+        self.published = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.max_lag = 0
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, frame):
+        """Copy a detected frame into a free slot and make it the latest one; returns its sequence number."""
+        with self._cond:
+            slot = next((i for i in range(len(self._frames)) if self._leases[i] == 0 and i != self._latest), None)
+            if slot is None:
+                self.dropped += 1
+                return None
+            self._leases[slot] = 1  # reserved while copying
+        image = self._images[slot]
+        if image is None or image.shape != frame.image.shape or image.dtype != frame.image.dtype:
+            image = self._images[slot] = np.empty_like(frame.image)
+        np.copyto(image, frame.image)
+        pooled = Frame(image, frame.boxes, frame.probs, frame.landmarks, frame.timestamp,
+                       frame.track_ids, frame.embeddings)
+        with self._cond:
+            self._leases[slot] = 0
+            if self._latest is not None and self._frames[self._latest].seq > self._last_read:
+                self.dropped += 1
+            self._seq += 1
+            pooled.seq = self._seq
+            self._frames[slot] = pooled
+            self._latest = slot
+            self.published += 1
+            self._cond.notify_all()
+            return pooled.seq
+
+    def clear(self):
+        """Withdraw the latest frame if nobody has taken it yet (e.g. the faces left)."""
+        with self._cond:
+            if self._latest is not None and self._frames[self._latest].seq > self._last_read:
+                self._latest = None
+
+    def wait_newer(self, seq, timeout=None):
+        """Block until a frame newer than `seq` is published and lease it; None on timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._latest is not None and self._frames[self._latest].seq > seq,
+                                       timeout):
+                return None
+            slot = self._latest
+            frame = self._frames[slot]
+            self._leases[slot] += 1
+            self.max_lag = max(self.max_lag, self._seq - max(seq, self._last_read) - 1)
+            self._last_read = max(self._last_read, frame.seq)
+            self.consumed += 1
+            return frame
+
+    def release(self, frame):
+        """Give a slot obtained from wait_newer back to the pool."""
+        with self._cond:
+            for i, f in enumerate(self._frames):
+                if f is frame and self._leases[i] > 0:
+                    self._leases[i] -= 1
+                    return
+
+    def stats(self):
+        with self._cond:
+            return {
+                "published": self.published,
+                "consumed": self.consumed,
+                "dropped": self.dropped,
+                "lag": self._seq - self._last_read,
+                "max_lag": self.max_lag,
+            }
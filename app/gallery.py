@@ -0,0 +1,417 @@
+import os
+import time
+import threading
+import numpy as np
+
+
+class EmbeddingGallery:
+    """Contiguous matrix of enrolled face embeddings with batched nearest-neighbour search.
+
+    A gallery restored by load_index searches the memory-mapped file directly and
+    copies it into its own float32 matrix only when it is first modified. `dirty`
+    tells whether it changed since it was last saved or restored.
+    """
+    def __init__(self, dim=512, capacity=1024):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((capacity, dim), np.float32)
+        self._sq_norms = np.zeros(capacity, np.float32)
+        self._ids = np.full(capacity, -1, np.int64)
+        self._rows = {}
+        self._size = 0
+        self.dirty = False
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._size = 0
+            self.dirty = True
+
+    def load(self, encodings):
+        """Replace the gallery contents with {id: embedding}."""
+        with self._lock:
+            self.clear()
+            if encodings:
+                self.extend(list(encodings.keys()), np.stack(list(encodings.values())))
+
+    def extend(self, ids, embeddings):
+        """Append many new embeddings at once; ids already present are overwritten one by one."""
+        embeddings = np.asarray(embeddings, np.float32).reshape(-1, self.dim)
+        with self._lock:
+            fresh = []
+            for i, id in enumerate(ids):
+                if id in self._rows:
+                    self.add(id, embeddings[i])
+                else:
+                    fresh.append(i)
+            start, count = self._size, len(fresh)
+            self._reserve(start + count)
+            block = embeddings[fresh]
+            self._matrix[start:start + count] = block
+            self._sq_norms[start:start + count] = np.einsum("ij,ij->i", block, block)
+            self._ids[start:start + count] = [ids[i] for i in fresh]
+            self._rows.update((ids[i], start + n) for n, i in enumerate(fresh))
+            self._size += count
+            self.dirty = True
+
+    def add(self, id, embedding):
+        embedding = np.asarray(embedding, np.float32).reshape(self.dim)
+        with self._lock:
+            row = self._rows.get(id)
+            self._reserve(self._size + (row is None))
+            if row is None:
+                row = self._size
+                self._size += 1
+                self._rows[id] = row
+                self._ids[row] = id
+            self._matrix[row] = embedding
+            self._sq_norms[row] = embedding @ embedding
+            self.dirty = True
+
+    def remove(self, id):
+        """Drop an embedding by moving the last row into its slot."""
+        with self._lock:
+            if id not in self._rows:
+                return False
+            self._reserve(self._size)
+            row = self._rows.pop(id)
+            last = self._size - 1
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._ids[row] = self._ids[last]
+                self._rows[int(self._ids[row])] = row
+            self._ids[last] = -1
+            self._size = last
+            self.dirty = True
+            return True
+
+    def match(self, queries, k=1):
+        """Return (ids, distances), both N x k, of the k closest entries for each query.
+
+        Distances are Euclidean and sorted ascending; missing neighbours are -1 / inf.
+        """
+        queries = np.asarray(queries, np.float32).reshape(-1, self.dim)
+        n = queries.shape[0]
+        ids = np.full((n, k), -1, np.int64)
+        distances = np.full((n, k), np.inf, np.float32)
+        with self._lock:
+            m = self._size
+            if m == 0 or n == 0:
+                return ids, distances
+            # ||q - g||^2 = ||q||^2 + ||g||^2 - 2 q.g, one GEMM for the whole batch
+            sq = self._sq_norms[:m] - 2.0 * (queries @ self._matrix[:m].T)
+            kk = min(k, m)
+            if kk < m:
+                top = np.argpartition(sq, kk - 1, axis=1)[:, :kk]
+            else:
+                top = np.broadcast_to(np.arange(m), (n, m))
+            top_sq = np.take_along_axis(sq, top, axis=1)
+            order = np.argsort(top_sq, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_sq = np.take_along_axis(top_sq, order, axis=1)
+            ids[:, :kk] = self._ids[top]
+        q_sq = np.einsum("ij,ij->i", queries, queries)[:, None]
+        distances[:, :kk] = np.sqrt(np.maximum(top_sq + q_sq, 0.0))
+        return ids, distances
+
+    def _reserve(self, size):
+        """Make room for `size` rows in writable float32 arrays (copying a mapped matrix)."""
+        capacity = self._matrix.shape[0]
+        if size <= capacity and self._matrix.flags.writeable and self._matrix.dtype == np.float32:
+            return
+        capacity = max(capacity, 1)
+        while capacity < size:
+            capacity *= 2
+        matrix = np.zeros((capacity, self.dim), np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms = np.zeros(capacity, np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        ids = np.full(capacity, -1, np.int64)
+        ids[:self._size] = self._ids[:self._size]
+        self._matrix, self._sq_norms, self._ids = matrix, sq_norms, ids
+
+    def save(self, path, tag="", dtype="float32"):
+        with self._lock:
+            _save_index(path, self.matrix, dtype, kind="exact", tag=tag, ids=self.ids)
+            self.dirty = False
+
+    def restore(self, data, matrix):
+        with self._lock:
+            self._map(data["ids"], matrix, data["sq_norms"])
+
+    def _map(self, ids, matrix, sq_norms):
+        """Search `matrix` (possibly a read-only memmap) in place; rows follow `ids`."""
+        self._matrix = matrix
+        self._sq_norms = np.array(sq_norms, np.float32)
+        self._ids = np.array(ids, np.int64)
+        self._size = len(self._ids)
+        self._rows = dict(zip(self._ids.tolist(), range(self._size)))
+        self.dirty = False
+
+
+class IVFIndex:
+    """Inverted-file index: k-means cells, each an EmbeddingGallery, searched nprobe at a time.
+
+    Until it is trained the index holds everything in a single cell and behaves
+    like exact search.
+    """
+    def __init__(self, dim=512, nprobe=8, min_train_size=20000):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self._lock = threading.RLock()
+        self._centroids = np.zeros((1, dim), np.float32)
+        self._cells = [EmbeddingGallery(dim)]
+        self._cell_of = {}
+        self.trained_size = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._cell_of)
+
+    def __contains__(self, id):
+        return id in self._cell_of
+
+    @property
+    def trained(self):
+        return self.trained_size > 0
+
+    @property
+    def ids(self):
+        return np.fromiter(self._cell_of.keys(), np.int64, len(self._cell_of))
+
+    def needs_training(self):
+        """True when the gallery is large enough to train, or has outgrown its cells 4x."""
+        size = len(self)
+        if not self.trained:
+            return size >= self.min_train_size
+        return size >= 4 * self.trained_size
+
+    def clear(self):
+        with self._lock:
+            self._centroids = np.zeros((1, self.dim), np.float32)
+            self._cells = [EmbeddingGallery(self.dim)]
+            self._cell_of.clear()
+            self.trained_size = 0
+            self.dirty = True
+
+    def load(self, encodings):
+        with self._lock:
+            self.clear()
+            self._cells[0].load(encodings)
+            self._cell_of = dict.fromkeys(encodings, 0)
+            if self.needs_training():
+                self.train()
+
+    def add(self, id, embedding):
+        embedding = np.asarray(embedding, np.float32).reshape(self.dim)
+        with self._lock:
+            cell = self._nearest_cells(embedding[None], 1)[0, 0]
+            old = self._cell_of.get(id)
+            if old is not None and old != cell:
+                self._cells[old].remove(id)
+            self._cells[cell].add(id, embedding)
+            self._cell_of[id] = cell
+            self.dirty = True
+
+    def remove(self, id):
+        with self._lock:
+            cell = self._cell_of.pop(id, None)
+            if cell is None:
+                return False
+            self.dirty = True
+            return self._cells[cell].remove(id)
+
+    def match(self, queries, k=1):
+        """Approximate k nearest neighbours, scanning the nprobe closest cells per query."""
+        queries = np.asarray(queries, np.float32).reshape(-1, self.dim)
+        n = queries.shape[0]
+        ids = np.full((n, k), -1, np.int64)
+        distances = np.full((n, k), np.inf, np.float32)
+        with self._lock:
+            if not self._cell_of or n == 0:
+                return ids, distances
+            probes = self._nearest_cells(queries, min(self.nprobe, len(self._cells)))
+            for cell in np.unique(probes):
+                rows = np.nonzero((probes == cell).any(axis=1))[0]
+                cell_ids, cell_dist = self._cells[cell].match(queries[rows], k)
+                merged_ids = np.concatenate([ids[rows], cell_ids], axis=1)
+                merged_dist = np.concatenate([distances[rows], cell_dist], axis=1)
+                order = np.argsort(merged_dist, axis=1)[:, :k]
+                ids[rows] = np.take_along_axis(merged_ids, order, axis=1)
+                distances[rows] = np.take_along_axis(merged_dist, order, axis=1)
+        return ids, distances
+
+    def train(self, iterations=10, seed=0):
+        """Cluster the current contents into about sqrt(N) cells with k-means and reassign them."""
+        with self._lock:
+            all_ids = np.concatenate([cell.ids for cell in self._cells])
+            vectors = np.concatenate([cell.matrix for cell in self._cells])
+            size = len(all_ids)
+            if size == 0:
+                return
+            nlist = int(np.clip(np.sqrt(size), 1, 4096))
+            rng = np.random.default_rng(seed)
+            sample = vectors[rng.choice(size, min(size, 64 * nlist), replace=False)]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assign = _nearest(sample, centroids, 1)[:, 0]
+                for c in range(nlist):
+                    members = sample[assign == c]
+                    if len(members):
+                        centroids[c] = members.mean(axis=0)
+            self._centroids = centroids
+            assign = np.concatenate([
+                _nearest(vectors[i:i + 8192], centroids, 1)[:, 0] for i in range(0, size, 8192)
+            ])
+            self._cells = []
+            for c in range(nlist):
+                members = np.nonzero(assign == c)[0]
+                cell = EmbeddingGallery(self.dim, max(1, len(members)))
+                cell.extend(all_ids[members].tolist(), vectors[members])
+                self._cells.append(cell)
+            self._cell_of = dict(zip(all_ids.tolist(), assign.tolist()))
+            self.trained_size = size
+            self.dirty = True
+        print(f"[Index] Trained {nlist} cells over {size} faces.")
+
+    def save(self, path, tag="", dtype="float32"):
+        with self._lock:
+            _save_index(
+                path, np.concatenate([cell.matrix for cell in self._cells]), dtype,
+                kind="ivf", tag=tag, centroids=self._centroids, trained_size=self.trained_size,
+                sizes=np.array([len(cell) for cell in self._cells], np.int64),
+                ids=np.concatenate([cell.ids for cell in self._cells]),
+            )
+            self.dirty = False
+
+    def restore(self, data, matrix):
+        """Cells are consecutive row ranges of the (memory-mapped) matrix."""
+        with self._lock:
+            self.clear()
+            self._centroids = np.array(data["centroids"], np.float32)
+            self.trained_size = int(data["trained_size"])
+            ids, sq_norms, start = data["ids"], data["sq_norms"], 0
+            self._cells = []
+            for cell, size in enumerate(data["sizes"].tolist()):
+                gallery = EmbeddingGallery(self.dim, 1)
+                gallery._map(ids[start:start + size], matrix[start:start + size], sq_norms[start:start + size])
+                self._cell_of.update(dict.fromkeys(ids[start:start + size].tolist(), cell))
+                self._cells.append(gallery)
+                start += size
+            self.dirty = False
+
+    def _nearest_cells(self, queries, count):
+        if len(self._cells) == 1:
+            return np.zeros((len(queries), 1), np.int64)
+        return _nearest(queries, self._centroids, count)
+
+
+def _nearest(queries, centroids, count):
+    """Indices of the `count` closest centroids for each query."""
+    sq = np.einsum("ij,ij->i", centroids, centroids) - 2.0 * (queries @ centroids.T)
+    if count >= sq.shape[1]:
+        return np.argsort(sq, axis=1)
+    top = np.argpartition(sq, count - 1, axis=1)[:, :count]
+    return np.take_along_axis(top, np.argsort(np.take_along_axis(sq, top, axis=1), axis=1), axis=1)
+
+
+INDEX_TYPES = ("exact", "ivf")
+
+
+def create_index(kind, dim=512, nprobe=8):
+    """Build the gallery index selected by AppSettings.index_type."""
+    if kind == "ivf":
+        return IVFIndex(dim, nprobe)
+    if kind == "exact":
+        return EmbeddingGallery(dim)
+    raise ValueError(f"Unknown index type {kind}, expected one of: " + ", ".join(INDEX_TYPES))
+
+
+def load_index(path, kind, tag="", dim=512, nprobe=8, dtype=None):
+    """Open an index saved with save(); returns None if missing, unreadable or of another kind/tag.
+
+    A file stored in another dtype than `dtype` loads fine but is marked dirty, so
+    the next save converts it.
+
+    The embedding matrix is memory-mapped read-only rather than read, so loading
+    costs the same for any gallery size, and processes that open the same file
+    share it through the page cache. Only the matrix file named in the .npz is
+    used, so an id map is never paired with another save's matrix.
+    """
+    try:
+        with np.load(path + ".npz") as data:
+            meta = {key: data[key] for key in data.files}
+        if str(meta["kind"]) != kind or str(meta["tag"]) != tag or "matrix" not in meta:
+            return None
+        size = len(meta["ids"])
+        matrix_path = os.path.join(os.path.dirname(path), str(meta["matrix"]))
+        matrix = np.load(matrix_path, mmap_mode="r") if size else np.zeros((0, dim), np.float32)
+        if matrix.shape != (size, dim):
+            print(f"[Index ERROR] {matrix_path} does not match its id map, rebuilding")
+            return None
+        index = create_index(kind, dim, nprobe)
+        index.restore(meta, matrix)
+        index.dirty = bool(size) and dtype is not None and matrix.dtype != np.dtype(dtype)
+        return index
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[Index ERROR] Failed to load {path}: {e}")
+        return None
+
+
+def _save_index(path, matrix, dtype, **meta):
+    """Write the embeddings to <path>.<generation>.npy (memory-mappable), then the id map and the rest to <path>.npz.
+
+    The .npz names its matrix file and is replaced last, so after a crash, or for a
+    process loading meanwhile, the id map always belongs to the matrix it points at.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype)
+    stored = matrix.astype(np.float32)
+    # norms of the stored (possibly float16-rounded) rows, so distances stay consistent
+    meta["sq_norms"] = np.einsum("ij,ij->i", stored, stored)
+    directory, base = os.path.split(os.path.abspath(path))
+    meta["matrix"] = f"{base}.{time.time_ns():x}{os.getpid():x}.npy"
+    _write_replace(os.path.join(directory, str(meta["matrix"])), lambda f: np.save(f, matrix))
+    _write_replace(path + ".npz", lambda f: np.savez(f, **meta))
+    # earlier generations; a process that mapped one keeps reading it until it unmaps it
+    for name in os.listdir(directory):
+        if name.startswith(base + ".") and name.endswith(".npy") and name != meta["matrix"]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def _write_replace(target, write):
+    """Write to a temporary file, flush it to disk and rename it over target (also made durable)."""
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, target)
+    try:
+        fd = os.open(os.path.dirname(target), os.O_RDONLY)
+    except OSError:
+        return  # directories can't be opened (and needn't be synced) on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -2,7 +2,6 @@ from PyQt5 import uic
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox
 from PyQt5.QtCore import pyqtSignal, QProcess, QBuffer, QIODevice
 from PyQt5.QtGui import QImage, QPixmap
-from recognizer import FaceDetector
 from messages import Message, MessageContainer
 from settings import AppSettings
 import database
@@ -14,12 +13,13 @@ import io
 
 class MainWindow(QMainWindow):
     size_changed = pyqtSignal(tuple)
-    def __init__(self, db, reader):
+    def __init__(self, db, reader, recognizer=None):
         super(QMainWindow, self).__init__()
         self.settings = AppSettings()
-        self.detector = FaceDetector()
         self.reader = reader
         self.db = db
+        # модели загружаются в фоне, см. set_recognizer
+        self.recognizer = recognizer
         self.ui = uic.loadUi("app/ui/mainwindow.ui")
         self.ui.show()
         self.ui.setButton.clicked.connect(self.change_settings)
@@ -91,14 +91,21 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self.addpage, "Ошибка", "Не удалось обработать фото")
             return
 
+        if self.recognizer is None:
+            QMessageBox.warning(self.addpage, "Ошибка", "Модели ещё загружаются, попробуйте позже")
+            return
+
         person = database.Person(name=name, cardId=card_id, img=img)
+        if self.recognizer.encode_person(person) is None:
+            QMessageBox.warning(self.addpage, "Ошибка", "Лицо на фото не найдено")
+            return
         self.db.add_person(person)
         QMessageBox.information(self.addpage, "Успех", f"Пользователь {name} добавлен")
         self._close_add_person()
 
     def _close_add_person(self):
         self.reader.disable_reading()
-        self.reader.new_card.disconnect()
+        self.reader.new_card.disconnect(self.addpage.cardIdEdit.setText)
         if self.onboard_process:
             self.onboard_process.kill()
             self.onboard_process = None
@@ -108,7 +115,10 @@ class MainWindow(QMainWindow):
         if self.image is None:
             QMessageBox.warning(self.addpage, "Ошибка", "Нет изображения с камеры")
             return
-        aligned_np = self.detector.align_to_np(self.image)
+        if self.recognizer is None:
+            QMessageBox.warning(self.addpage, "Ошибка", "Модели ещё загружаются, попробуйте позже")
+            return
+        aligned_np = self.recognizer.detector.align_to_np(self.image)
         pixmap = self.pixmap_from_np(aligned_np)
         self.addpage.photoLabel.setPixmap(pixmap)
 
@@ -145,6 +155,9 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self.delpage, "Удалено", f"Пользователь {person.name} удалён")
             self._refresh_persons_list()
 
+    def set_recognizer(self, recognizer):
+        self.recognizer = recognizer
+
     def pixmap_from_np(self, image):
         h, w, ch = image.shape
         bytesPerLine = w * ch
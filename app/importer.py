@@ -0,0 +1,216 @@
+"""
+importer.py – headless bulk enrollment
+
+Reads photos with card ids and names, then detects, aligns and embeds them in a
+pool of worker processes. The results are written to the database in batched
+transactions, together with their embeddings. The terminal therefore only loads
+them on its next start and never re-encodes them.
+
+Input is either a CSV with the columns card_id,name,photo (photo paths relative
+to the CSV), or a directory of photos named <card_id>_<name>.jpg.
+
+    python app/importer.py staff.csv
+    python app/importer.py photos/ --db persons.db --workers 8
+
+Every photo that is written or rejected is appended to a checkpoint file next to
+the database. Running the same command again after an interruption therefore
+skips the finished work. Rejected photos are listed with the reason in a CSV
+report: unreadable, no face, several faces, duplicate card, or the card is
+already enrolled.
+"""
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+# longest side of the photo kept in the database; the embedding uses the full-size photo
+STORED_PHOTO_SIZE = 640
+
+
+def read_csv(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield row["card_id"].strip(), row["name"].strip(), os.path.join(base, row["photo"].strip())
+
+
+def read_directory(path):
+    for filename in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in IMAGE_EXTENSIONS or "_" not in stem:
+            continue
+        card_id, name = stem.split("_", 1)
+        yield card_id, name.replace("_", " "), os.path.join(path, filename)
+
+
+_detector = None
+_embedder = None
+
+
+def _init_worker(torch_threads):
+    global _detector, _embedder
+    import torch
+    from recognizer import FaceDetector
+    from backends import load_embedder
+    torch.set_num_threads(torch_threads)
+    _detector = FaceDetector()
+    _embedder = load_embedder(_detector.settings.backend, _detector.device, _detector.settings.threshold,
+                              threads=torch_threads)
+
+
+def _process_chunk(rows):
+    """Detect and align every photo of the chunk, then embed the accepted faces in one batch.
+
+    Returns (card_id, name, photo, reason, stored image, embedding) per row; reason is None when accepted.
+    """
+    import numpy as np
+    import torch
+    from PIL import Image
+    results, crops = [], []
+    for card_id, name, photo in rows:
+        try:
+            image = Image.open(photo).convert("RGB")
+        except Exception as e:
+            results.append([card_id, name, photo, f"unreadable: {e}", None, None])
+            continue
+        boxes, _ = _detector.mtcnn.detect(image)
+        if boxes is None:
+            results.append([card_id, name, photo, "no face", None, None])
+            continue
+        if len(boxes) > 1:
+            results.append([card_id, name, photo, f"several faces ({len(boxes)})", None, None])
+            continue
+        crops.append((len(results), _detector.mtcnn.extract(image, boxes[:1], None)))
+        image.thumbnail((STORED_PHOTO_SIZE, STORED_PHOTO_SIZE))
+        results.append([card_id, name, photo, None, image, None])
+    if crops:
+        with torch.no_grad():
+            embeddings = _embedder(torch.cat([c for _, c in crops]).to(_detector.device)).cpu().numpy()
+        for (row, _), embedding in zip(crops, embeddings.astype(np.float32)):
+            results[row][5] = embedding
+    return results
+
+
+class Checkpoint:
+    """Append-only log of finished photos: {"photo": ..., "status": "added" | reason}."""
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by an interruption
+                    self.done[entry["photo"]] = entry["status"]
+        self.file = open(path, "a", encoding="utf-8")
+
+    def record(self, photos_and_statuses):
+        for photo, status in photos_and_statuses:
+            self.done[photo] = status
+            self.file.write(json.dumps({"photo": photo, "status": status}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="CSV file (card_id,name,photo) or directory of <card_id>_<name>.jpg")
+    parser.add_argument("--db", default="persons.db")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--torch-threads", type=int, default=1, help="torch threads per worker process")
+    parser.add_argument("--chunk", type=int, default=16, help="photos per worker task (one embedding batch)")
+    parser.add_argument("--batch", type=int, default=200, help="persons per database transaction")
+    parser.add_argument("--rejects", default=None, help="CSV report of rejected photos (default: <db>.rejects.csv)")
+    parser.add_argument("--retry-rejects", action="store_true", help="process photos rejected by an earlier run again")
+    args = parser.parse_args()
+
+    from database import SQLiteDatabase, Person
+    from recognizer import MODEL_TAG
+
+    rows = list(read_csv(args.source) if os.path.isfile(args.source) else read_directory(args.source))
+    checkpoint = Checkpoint(args.db + ".import.jsonl")
+    # photos already added are always skipped, rejected ones unless --retry-rejects
+    skip = {photo for photo, status in checkpoint.done.items() if status == "added" or not args.retry_rejects}
+    rows = [r for r in rows if r[2] not in skip]
+    print(f"[Import] {len(rows)} photos to process ({len(checkpoint.done)} done in earlier runs)")
+
+    db = SQLiteDatabase(args.db)
+    rejects_path = args.rejects or args.db + ".rejects.csv"
+    new_report = not os.path.isfile(rejects_path)
+    report = open(rejects_path, "a", newline="", encoding="utf-8")
+    rejects = csv.writer(report)
+    if new_report:
+        rejects.writerow(["card_id", "name", "photo", "reason"])
+
+    # cards committed by this run, and cards waiting in the current batch
+    seen_cards, pending_cards = set(), set()
+    pending, finished = [], []
+    counts = {"added": 0, "rejected": 0}
+    started = time.perf_counter()
+
+    def reject(card_id, name, photo, reason):
+        rejects.writerow([card_id, name, photo, reason])
+        finished.append((photo, reason))
+        counts["rejected"] += 1
+
+    def flush():
+        # the checkpoint is written only after the transaction, so a crash never skips uncommitted persons
+        if pending:
+            added = db.add_persons([p for p, _ in pending])
+            for person, photo in pending:
+                if added:
+                    finished.append((photo, "added"))
+                else:
+                    reject(person.cardId, person.name, photo, "database error")
+            if added:
+                seen_cards.update(pending_cards)
+            # after a failed batch a later photo of the same card may still be added
+            pending_cards.clear()
+            counts["added"] += added
+            pending.clear()
+        report.flush()
+        checkpoint.record(finished)
+        finished.clear()
+
+    chunks = [rows[i:i + args.chunk] for i in range(0, len(rows), args.chunk)]
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.workers, initializer=_init_worker, initargs=(args.torch_threads,)) as pool:
+        for results in pool.imap_unordered(_process_chunk, chunks):
+            for card_id, name, photo, reason, image, embedding in results:
+                if reason is None and (card_id in seen_cards or card_id in pending_cards):
+                    reason = "duplicate card in input"
+                elif reason is None and db.get_person_by_cardid(card_id).id != -1:
+                    reason = "card already enrolled"
+                if reason is not None:
+                    reject(card_id, name, photo, reason)
+                    continue
+                pending_cards.add(card_id)
+                pending.append((Person(cardId=card_id, name=name, img=image,
+                                       embedding=embedding, embedding_model=MODEL_TAG), photo))
+            if len(pending) >= args.batch:
+                flush()
+                done = counts["added"] + counts["rejected"]
+                rate = done / (time.perf_counter() - started)
+                print(f"[Import] {done}/{len(rows)} ({rate:.1f} photos/s, {counts['rejected']} rejected)")
+    flush()
+
+    elapsed = time.perf_counter() - started
+    print(f"[Import] Added {counts['added']}, rejected {counts['rejected']} in {elapsed:.1f} s; "
+          f"rejects listed in {rejects_path}")
+    checkpoint.close()
+    report.close()
+    db.close()
+    return 0 if counts["added"] or not rows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
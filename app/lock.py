@@ -1,10 +1,14 @@
-from PyQt5.QtCore import QThread
+from PyQt5.QtCore import QThread, Qt
 import time
+import threading
 from database import SQLiteDatabase, Person
 from reader import RC522Reader
 from settings import AppSettings
 from messages import MessageContainer, Message
-from queue import Queue, Empty
+from frames import FrameBuffer
+from quality import FaceQuality, REASONS
+import startup
+import metrics
 
 gpio_available = True
 try:
@@ -16,8 +20,8 @@ except ImportError:
 
 class Lock:
     """Controls a physical door lock via GPIO"""
-    def __init__(self):
-        self.door_pin = 12
+    def __init__(self, door_pin=12):
+        self.door_pin = door_pin
         self.settings = AppSettings()
         self.messages = MessageContainer()
 
@@ -47,78 +51,225 @@ class Lock:
         self.messages.put(Message("The door is closed", (255, 170, 150), time.time(), 3))
 
 
-class LockThread(QThread):
-    """Background thread managing recognition and access control logic"""
-    def __init__(self, db: SQLiteDatabase, recognizer, reader: RC522Reader, frame_queue: Queue):
-        super().__init__()
+class AccessController:
+    """Access decisions for one door, driven by recognition results, card scans and timers.
+
+    Nothing here blocks. A recognized face opens a card session that a timer
+    expires after wait_time. A card scan is handled in the reader's thread as
+    soon as it arrives. An open door is closed by a timer, and a further grant
+    extends it. Several people can have sessions open at once; a card is matched
+    against all of them.
+    """
+    def __init__(self, lock: Lock, reader: RC522Reader, name="door"):
         self.settings = AppSettings()
-        self.db = db
-        self.recognizer = recognizer
+        self.lock = lock
         self.reader = reader
-        self.queue = frame_queue
-        self.lock = Lock()
         self.messages = MessageContainer()
-
         self.default_name = Person().name
-        self.reader.start()
-
-    def run(self):
-        while True:
-            try:
-                image = self.queue.get(timeout=1)
-            except Empty:
-                continue
+        self.sessions = {}  # person id -> (person, timeout timer, time.time() of the request)
+        self.card_wait = metrics.registry.histogram("faceauth_lock_stage_seconds", "Time per access-control stage",
+                                                    camera=name, stage="card_wait")
+        self.unlock_time = metrics.registry.histogram("faceauth_lock_stage_seconds", "Time per access-control stage",
+                                                      camera=name, stage="unlock")
+        self.decisions = {
+            result: metrics.registry.counter("faceauth_access_decisions_total", "Access decisions by result",
+                                             camera=name, result=result)
+            for result in ("granted", "unknown_face", "unknown_in_group", "wrong_card", "card_timeout")
+        }
+        self.door_timer = None
+        # bumped whenever a session ends without a grant or the door closes, so the lock
+        # thread decides again for people who are still in view
+        self.generation = 0
+        self._mutex = threading.RLock()
+        self.reader.new_card.connect(self.card_scanned, Qt.DirectConnection)
 
-            if self.settings.mode == "multiple":
-                persons = self.recognizer.recognize_all(image)
-                self.process_multiple(persons)
-            elif self.settings.mode == "single":
-                person = self.recognizer.recognize_single(image)
-                self.process_single(person)
+    @property
+    def door_open(self):
+        return self.door_timer is not None
 
-    def process_single(self, person: Person):
+    def face_recognized(self, person: Person):
+        """Single mode: a recognized person is asked for their card."""
         if person.name == self.default_name:
+            self.decisions["unknown_face"].inc()
             self.messages.put(Message("Access denied: person wasn't recognized", (255, 150, 150), time.time(), 3))
             print("Access denied: unknown face")
             return
 
-        print(f"Face recognized as {person.name}")
-        self.messages.put(Message(f"Recognized: {person.name}", (150, 255, 150), time.time(), 10))
-        self.reader.enable_reading()
-        self.messages.put(Message("Please scan your card", (150, 150, 255), time.time(), self.settings.wait_time))
-
-        card_id = None
-        for _ in range(self.settings.wait_time):
-            card_id = self.reader.get_last_id()
-            if card_id:
-                break
-            time.sleep(1)
+        with self._mutex:
+            if person.id in self.sessions:
+                return
+            print(f"Face recognized as {person.name}")
+            self.messages.put(Message(f"Recognized: {person.name}", (150, 255, 150), time.time(), 10))
+            timer = self._timer(self.settings.wait_time, self._session_expired, person.id)
+            if not self.sessions:
+                self.reader.enable_reading()
+            self.sessions[person.id] = (person, timer, time.time())
+            self.messages.put(Message("Please scan your card", (150, 150, 255), time.time(), self.settings.wait_time))
 
-        self.reader.disable_reading()
-
-        if not card_id:
-            self.messages.put(Message("Timeout: card not scanned", (255, 150, 150), time.time(), 5))
-            print("Card scan timeout")
-            return
-
-        if card_id == person.cardId:
-            self.messages.put(Message(f"Access granted: {person.name}", (150, 255, 150), time.time(), 5))
-            self.lock.open()
-            time.sleep(self.settings.open_time)
-            self.lock.close()
-        else:
-            self.messages.put(Message("Access denied: wrong card", (255, 100, 150), time.time(), 5))
-            print("Access denied: card mismatch")
-
-    def process_multiple(self, persons):
+    def group_recognized(self, persons):
+        """Multiple mode: the door opens only if everybody in view is known."""
         names = [p.name for p in persons]
         print("Recognized persons:", names)
 
         if self.default_name not in names:
+            t = metrics.now()
+            self.decisions["granted"].inc()
             self.messages.put(Message("Access granted for all", (150, 255, 150), time.time(), 5))
-            self.lock.open()
-            time.sleep(self.settings.open_time)
-            self.lock.close()
+            self.open_door()
+            self.unlock_time.observe_since(t)
         else:
+            self.decisions["unknown_in_group"].inc()
             self.messages.put(Message("Access denied: unknown person in group", (255, 150, 150), time.time(), 5))
-            print("Access denied: some persons were not recognized")
\ No newline at end of file
+            print("Access denied: some persons were not recognized")
+
+    def card_scanned(self, card_id):
+        t = metrics.now()
+        with self._mutex:
+            if not self.sessions:
+                return
+            session = next((s for s in self.sessions.values() if s[0].cardId == card_id), None)
+            if session is None:
+                # wrong card: open sessions stay until their timeout so the right card can still follow
+                self.decisions["wrong_card"].inc()
+                self.generation += 1
+                self.messages.put(Message("Access denied: wrong card", (255, 100, 150), time.time(), 5))
+                print("Access denied: card mismatch")
+                return
+            person, _, requested = session
+            self._end_session(person.id)
+        if metrics.enabled:
+            self.card_wait.observe(time.time() - requested)
+        self.decisions["granted"].inc()
+        self.messages.put(Message(f"Access granted: {person.name}", (150, 255, 150), time.time(), 5))
+        self.open_door()
+        self.unlock_time.observe_since(t)
+
+    def open_door(self):
+        """Open the lock for open_time; a grant while it is open restarts the countdown."""
+        with self._mutex:
+            if self.door_timer is not None:
+                self.door_timer.cancel()
+            self.lock.open()
+            self.door_timer = self._timer(self.settings.open_time, self._close_door)
+
+    def stop(self):
+        with self._mutex:
+            for person_id in list(self.sessions):
+                self._end_session(person_id)
+            if self.door_timer is not None:
+                self.door_timer.cancel()
+                self.door_timer = None
+                self.lock.close()
+
+    def _session_expired(self, person_id):
+        with self._mutex:
+            if person_id not in self.sessions:
+                return
+            self._end_session(person_id)
+            self.generation += 1
+        self.decisions["card_timeout"].inc()
+        self.messages.put(Message("Timeout: card not scanned", (255, 150, 150), time.time(), 5))
+        print("Card scan timeout")
+
+    def _end_session(self, person_id):
+        _, timer, _ = self.sessions.pop(person_id)
+        timer.cancel()
+        if not self.sessions:
+            self.reader.disable_reading()
+
+    def _close_door(self):
+        with self._mutex:
+            if self.door_timer is not threading.current_thread():
+                return  # superseded by a later open_door
+            self.door_timer = None
+            self.generation += 1
+            self.lock.close()
+
+    def _timer(self, seconds, callback, *args):
+        timer = threading.Timer(seconds, callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class LockThread(QThread):
+    """Background thread feeding recognition results into the door's AccessController"""
+    def __init__(self, db: SQLiteDatabase, recognizer, reader: RC522Reader, frame_buffer: FrameBuffer, tracker,
+                 lock=None, name="door", quality=None):
+        super().__init__()
+        self.settings = AppSettings()
+        self.db = db
+        self.recognizer = recognizer
+        self.reader = reader
+        self.buffer = frame_buffer
+        self.tracker = tracker
+        self.last_decision = None
+        self.last_seq = 0
+        self.lock = Lock() if lock is None else lock
+        self.access = AccessController(self.lock, self.reader, name)
+        self.quality = FaceQuality.from_settings(self.settings) if quality is None else quality
+        self.quality_checks = {
+            result: metrics.registry.counter("faceauth_face_quality_total",
+                                             "Faces checked before embedding, by result", camera=name, result=result)
+            for result in ("passed",) + REASONS
+        }
+        self.decision_time = metrics.registry.histogram("faceauth_lock_stage_seconds", "Time per access-control stage",
+                                                        camera=name, stage="decision")
+        self.capture_to_decision = metrics.registry.histogram(
+            "faceauth_capture_to_decision_seconds", "From camera capture to a new access decision", camera=name)
+        self.messages = MessageContainer()
+
+    def run(self):
+        # frames keep being consumed while a card is awaited or the door is open
+        while True:
+            frame = self.buffer.wait_newer(self.last_seq, timeout=1)
+            if frame is None:
+                continue
+            self.last_seq = frame.seq
+            captured = frame.timestamp
+            t = metrics.now()
+            try:
+                track_ids, persons = self.identify_tracks(frame)
+            finally:
+                self.buffer.release(frame)
+            if persons is None:
+                continue
+            startup.mark("first recognition")
+            # decide once per set of tracks and identities, not on every frame, and again
+            # after a session ended or the door closed while they are still in view
+            decision = (self.access.generation,) + tuple((track, p.id) for track, p in zip(track_ids, persons))
+            if decision == self.last_decision:
+                metrics.lap(self.decision_time, t)
+                continue
+            self.last_decision = decision
+
+            if self.settings.mode == "multiple":
+                self.access.group_recognized(persons)
+            elif self.settings.mode == "single":
+                self.access.face_recognized(persons[0])
+            metrics.lap(self.decision_time, t)
+            if metrics.enabled:
+                self.capture_to_decision.observe(time.time() - captured)
+
+    def identify_tracks(self, frame):
+        """Embed only tracks whose cached identity is missing or stale, and only good-quality faces.
+
+        A face failing the quality checks keeps its track's cached identity and is
+        tried again on a later frame. Returns the considered track ids and their
+        persons, or None for persons while some of them could not be recognized yet.
+        """
+        track_ids = frame.track_ids
+        if self.settings.mode == "single":
+            track_ids = track_ids[:1]  # the largest face comes first
+        stale = [i for i, t in enumerate(track_ids) if self.tracker.needs_verification(t, self.settings.threshold)]
+        stale, rejected = self.quality.split(frame, stale)
+        self.quality_checks["passed"].inc(len(stale))
+        for reason in rejected.values():
+            self.quality_checks[reason].inc()
+        if stale:
+            for i, (person, distance) in zip(stale, self.recognizer.identify(frame, stale)):
+                self.tracker.set_identity(track_ids[i], person, distance)
+        persons = self.tracker.persons(track_ids)
+        if not persons or any(p is None for p in persons):
+            return track_ids, None
+        return track_ids, persons
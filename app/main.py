@@ -1,12 +1,17 @@
+import startup  # первым: от его импорта отсчитывается время старта
 import sys
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton
 from gui import MainWindow
-from recognizer import InceptionResnetV1Recognizer
 from database import SQLiteDatabase
-from lock import LockThread
-from video import VideoThread
+from lock import LockThread, Lock
+from video import VideoThread, FaceTracker
 from reader import RC522Reader
-import queue as q
+from settings import AppSettings
+from frames import FrameBuffer
+from workers import InferencePool
+from quality import FaceQuality
+from startup import ModelLoader
+import metrics
 
 
 def main():
@@ -14,27 +19,59 @@ def main():
     # database.create_test_db(db_path)  # если нужно, раскомментируй
     db = SQLiteDatabase(db_path)
     reader = RC522Reader()
-    frame_queue = q.Queue(maxsize=1)
-    recognizer = InceptionResnetV1Recognizer(db)
+    settings = AppSettings()
+    if settings.metrics_port:
+        metrics.serve(settings.metrics_port)
 
     app = QApplication(sys.argv)
     main_w = MainWindow(db, reader)
+    reader.start()
+    app.aboutToQuit.connect(reader.stop)
 
-    video_thread = VideoThread(frame_queue)
-    lock_thread = LockThread(db, recognizer, reader, frame_queue)
+    # Каждая камера — свой поток захвата, трекер и замок; модель одна на всех,
+    # и процессы инференса (если включены) тоже общие
+    pool = None
+    if settings.inference_workers > 0:
+        pool = InferencePool(settings.inference_workers, settings.torch_threads, settings.inference_cpus)
+    video_threads, buffers, trackers = [], [], []
+    for camera in settings.cameras:
+        buffers.append(FrameBuffer())
+        trackers.append(FaceTracker(reverify_interval=settings.reverify_interval))
+        video_threads.append(VideoThread(buffers[-1], trackers[-1], camera, pool=pool))
+        app.aboutToQuit.connect(video_threads[-1].stop)
+    if pool is not None:
+        # после остановки камер
+        app.aboutToQuit.connect(pool.stop)
 
-    main_w.size_changed.connect(video_thread.change_size)
-    video_thread.new_frame_change.connect(main_w.change_frame)
+    # На экран выводится первая камера
+    main_w.size_changed.connect(video_threads[0].change_size)
+    video_threads[0].new_frame_change.connect(main_w.change_frame)
 
     main_w.show_full_screen()
+    startup.mark("window shown")
 
-    # Запускаем потоки
-    lock_thread.start()
-    video_thread.start()
+    # Камеры запускаются сразу, распознавание — когда модели загрузятся в фоне
+    for video_thread in video_threads:
+        video_thread.start()
+
+    lock_threads = []
+
+    def models_loaded(recognizer):
+        main_w.set_recognizer(recognizer)
+        app.aboutToQuit.connect(recognizer.save_index)
+        for camera, buffer, tracker, video_thread in zip(settings.cameras, buffers, trackers, video_threads):
+            video_thread.set_detector(recognizer.detector)
+            lock_threads.append(LockThread(db, recognizer, reader, buffer, tracker, Lock(camera["lock_pin"]),
+                                           camera["name"], FaceQuality.from_settings(settings, camera)))
+            app.aboutToQuit.connect(lock_threads[-1].access.stop)
+            lock_threads[-1].start()
+
+    loader = ModelLoader(db)
+    loader.loaded.connect(models_loaded)
+    loader.start()
 
     sys.exit(app.exec())
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,31 +1,92 @@
 import numpy as np
+import heapq
+import itertools
+import threading
 import time
 
 
 
 class MessageContainer():
+    """Process-wide queue of on-screen messages, shared by every thread that posts them.
+
+    Entries sit in a heap ordered by expiry time, so dropping expired messages costs
+    O(log n) each. Posting a message that is already shown (same text and color)
+    only extends it. When more than CAPACITY messages are live, the one that expires
+    soonest is dropped. The renderer reads an immutable snapshot and draws it
+    without holding the lock.
+    """
+    CAPACITY = 16
+
     def __init__(self):
-        self.messages=[]
-        self.iter=None
+        # singleton: every MessageContainer() returns the same, already initialized object
+        if hasattr(self, "_lock"):
+            return
+        self._lock = threading.Lock()
+        self._heap = []
+        self._live = {}
+        self._seq = itertools.count()
+        self._snapshot = ()
+        self._changed = False
 
     def __iter__(self):
-        self.iter = iter(self.messages)
-        return self
-
-    def __next__(self):
-        m = next(self.iter)
-        t = time.time()
-        if t > m.start_time + m.duration:
-            self.messages.remove(m)
-            return next(self)
-        m.transparency = np.sin(np.pi* (((m.start_time-t)+m.duration)/m.duration)/2)
-        return m
+        now = time.time()
+        for m in self.snapshot(now):
+            m.transparency = m.alpha(now)
+            yield m
 
     def __len__(self):
-        return len(self.messages)
+        with self._lock:
+            return len(self._live)
 
     def put(self, message):
-        self.messages.append(message)
+        key = (message.text, tuple(message.color))
+        with self._lock:
+            seq = next(self._seq)
+            entry = self._live.get(key)
+            if entry is not None:
+                # the same notice again: keep its place on screen, restart its timer
+                entry[1] = seq
+                shown = entry[2]
+                shown.start_time, shown.duration = message.start_time, message.duration
+            else:
+                self._live[key] = [seq, seq, message]
+                self._changed = True
+            heapq.heappush(self._heap, (message.start_time + message.duration, seq, key))
+            while len(self._live) > self.CAPACITY:
+                self._pop()
+            if len(self._heap) > 4 * self.CAPACITY:
+                self._compact()
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+            self._live.clear()
+            self._snapshot = ()
+            self._changed = False
+
+    def snapshot(self, now=None):
+        """Live messages in the order they were first posted, as a tuple."""
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                self._pop()
+            if self._changed:
+                self._snapshot = tuple(entry[2] for entry in sorted(self._live.values(), key=lambda e: e[0]))
+                self._changed = False
+            return self._snapshot
+
+    def _pop(self):
+        """Remove the heap top; it only drops a message if it is that message's latest entry."""
+        _, seq, key = heapq.heappop(self._heap)
+        entry = self._live.get(key)
+        if entry is not None and entry[1] == seq:
+            del self._live[key]
+            self._changed = True
+
+    def _compact(self):
+        """Forget heap entries superseded by later puts of the same message."""
+        self._heap = [item for item in self._heap if self._live.get(item[2], (None, None))[1] == item[1]]
+        heapq.heapify(self._heap)
 
     def __new__(cls):
         if not hasattr(cls, 'instance'):
@@ -39,3 +100,7 @@ class Message():
         self.start_time = start_time
         self.duration = duration
         self.transparency = 1
+
+    def alpha(self, now):
+        """Opacity at time `now`: fades out over the message's lifetime."""
+        return float(np.sin(np.pi* (((self.start_time-now)+self.duration)/self.duration)/2))
@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram():
+    """Thread-safe histogram with fixed upper bucket bounds (plus an overflow bucket)."""
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (inf if it is the overflow bucket)."""
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return 0.0
+        rank, seen = q * total, 0
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "counts": list(self.counts),
+                "sum": self.sum,
+                "count": self.count,
+            }
+
+    def observe_since(self, start):
+        """Record the seconds elapsed since `start`, a value returned by now() (skipped when it is None)."""
+        if start is not None:
+            self.observe(time.perf_counter() - start)
+
+
+class Counter():
+    """Thread-safe monotonically increasing count."""
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+# seconds; covers everything from a crop conversion to a card wait
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Timing hooks cost one perf_counter call while the endpoint runs and nothing else
+# otherwise: now() returns None and observe_since() ignores it.
+enabled = False
+
+
+def now():
+    return time.perf_counter() if enabled else None
+
+
+def lap(histogram, start):
+    """histogram.observe_since(start) and return the new start, for timing consecutive stages."""
+    if start is None:
+        return None
+    end = time.perf_counter()
+    histogram.observe(end - start)
+    return end
+
+
+class Registry():
+    """Named metrics with optional labels, rendered in the Prometheus text format."""
+    def __init__(self):
+        self._metrics = {}  # name -> (kind, help, {labels: metric or callable})
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(name, "histogram", help, labels, lambda: Histogram(buckets))
+
+    def counter(self, name, help, **labels):
+        return self._get(name, "counter", help, labels, Counter)
+
+    def register(self, name, kind, help, metric, **labels):
+        """Export an existing Histogram, or a callable returning the current value of a counter/gauge."""
+        with self._lock:
+            self._metrics.setdefault(name, (kind, help, {}))[2][tuple(sorted(labels.items()))] = metric
+        return metric
+
+    def _get(self, name, kind, help, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metrics.setdefault(name, (kind, help, {}))[2]
+            if key not in series:
+                series[key] = factory()
+            return series[key]
+
+    def render(self):
+        with self._lock:
+            metrics = [(name, kind, help, list(series.items())) for name, (kind, help, series) in self._metrics.items()]
+        lines = []
+        for name, kind, help, series in sorted(metrics):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                if kind == "histogram":
+                    snapshot = metric.snapshot()
+                    cumulative = 0
+                    for bound, count in zip(snapshot["buckets"] + ["+Inf"], snapshot["counts"]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+                    lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+                else:
+                    value = metric.value if isinstance(metric, Counter) else metric()
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+registry = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the console
+
+
+def serve(port, host="127.0.0.1"):
+    """Expose /metrics on localhost and switch the timing hooks on."""
+    global enabled
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    enabled = True
+    print(f"[Metrics] Serving http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,100 @@
+"""
+quality.py – cheap face-quality checks between detection and embedding
+
+A face is embedded only if it is big enough, MTCNN is confident about it, the
+crop is sharp and the head is not turned too far. Everything else would cost an
+InceptionResnetV1 forward pass and still not match. It is better to wait for a
+better frame of the same track.
+"""
+import cv2
+import numpy as np
+
+# rejection reasons, in the order the checks run (cheapest first)
+REASONS = ("small", "low_prob", "blurry", "turned")
+# side of the square grayscale crop the Laplacian is taken on, so sharpness doesn't depend on face size
+SHARPNESS_SIZE = 64
+# nose height between the eye line and the mouth line on a frontal face
+FRONTAL_NOSE_RATIO = 0.55
+
+
+def sharpness(image, box):
+    """Variance of the Laplacian of the face crop; low values mean blur."""
+    h, w = image.shape[:2]
+    x1, y1 = max(0, int(box[0])), max(0, int(box[1]))
+    x2, y2 = min(w, int(box[2])), min(h, int(box[3]))
+    if x2 - x1 < 2 or y2 - y1 < 2:
+        return 0.0
+    crop = image[y1:y2, x1:x2]
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    crop = cv2.resize(crop, (SHARPNESS_SIZE, SHARPNESS_SIZE), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(crop, cv2.CV_32F).var())
+
+
+def pose(landmarks):
+    """Rough (yaw, pitch) from MTCNN's five landmarks, both 0 for a frontal face.
+
+    Yaw is the nose's sideways offset from the eye midpoint in inter-eye distances.
+    Pitch is how far the nose sits from its frontal height between eyes and mouth.
+    Roll is removed first, since alignment corrects it anyway.
+    """
+    left_eye, right_eye, nose, mouth_left, mouth_right = np.asarray(landmarks, np.float32)
+    eyes = (left_eye + right_eye) / 2
+    axis = right_eye - left_eye
+    eye_distance = float(np.hypot(*axis))
+    if eye_distance < 1e-3:
+        return float("inf"), float("inf")
+    cos, sin = axis / eye_distance
+    rotation = np.array([[cos, sin], [-sin, cos]], np.float32)
+    nose = rotation @ (nose - eyes)
+    mouth = rotation @ ((mouth_left + mouth_right) / 2 - eyes)
+    yaw = nose[0] / eye_distance
+    pitch = nose[1] / mouth[1] - FRONTAL_NOSE_RATIO if mouth[1] > 1e-3 else float("inf")
+    return float(yaw), float(pitch)
+
+
+class FaceQuality:
+    """Per-door quality thresholds; a threshold of 0 turns its check off.
+
+    Plain attributes only, so an instance can be handed to the inference processes.
+    """
+    def __init__(self, min_face_size=40, min_prob=0.95, min_sharpness=15.0, max_yaw=0.4, max_pitch=0.3):
+        self.min_face_size = min_face_size
+        self.min_prob = min_prob
+        self.min_sharpness = min_sharpness
+        self.max_yaw = max_yaw
+        self.max_pitch = max_pitch
+
+    @classmethod
+    def from_settings(cls, settings, camera=None):
+        """Global face_quality settings, overridden by the camera's own "face_quality" entry."""
+        thresholds = dict(settings.face_quality)
+        if camera is not None:
+            thresholds.update(camera.get("face_quality", {}))
+        return cls(**thresholds)
+
+    def check(self, frame, i):
+        """Reason the i-th face of a Frame should not be embedded, or None if it is good enough."""
+        box = frame.boxes[i]
+        if self.min_face_size and min(box[2] - box[0], box[3] - box[1]) < self.min_face_size:
+            return "small"
+        if self.min_prob and i < len(frame.probs) and frame.probs[i] < self.min_prob:
+            return "low_prob"
+        if self.min_sharpness and sharpness(frame.image, box) < self.min_sharpness:
+            return "blurry"
+        if (self.max_yaw or self.max_pitch) and i < len(frame.landmarks):
+            yaw, pitch = pose(frame.landmarks[i])
+            if (self.max_yaw and abs(yaw) > self.max_yaw) or (self.max_pitch and abs(pitch) > self.max_pitch):
+                return "turned"
+        return None
+
+    def split(self, frame, indices=None):
+        """Divide faces into (accepted indices, {index: reason}) of the rejected ones."""
+        accepted, rejected = [], {}
+        for i in range(len(frame)) if indices is None else indices:
+            reason = self.check(frame, i)
+            if reason is None:
+                accepted.append(i)
+            else:
+                rejected[i] = reason
+        return accepted, rejected
@@ -2,69 +2,178 @@ from PyQt5.QtCore import QThread, pyqtSignal
 import serial
 from serial.tools import list_ports
 from messages import MessageContainer, Message
+from settings import AppSettings
+from collections import namedtuple
 import time
+import threading
+
+# one accepted card swipe: the id as sent by the reader, time.time() of its arrival, serial port
+CardEvent = namedtuple("CardEvent", ["card_id", "timestamp", "port"])
+
+
+class CardFramer:
+    """Splits the reader's byte stream into card ids, one per line, as the bytes arrive."""
+    def __init__(self, max_length=64):
+        self.max_length = max_length
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes; returns the ids of every line completed by them."""
+        self.buffer += data
+        ids = []
+        while True:
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            card_id = line.decode("utf-8", errors="replace").strip()
+            if card_id:
+                ids.append(card_id)
+        if len(self.buffer) > self.max_length:
+            # garbage without line ends (wrong baud rate, noise) must not grow forever
+            self.buffer.clear()
+        return ids
+
+    def reset(self):
+        self.buffer.clear()
+
 
 class RC522Reader(QThread):
+    """Serial RFID reader.
+
+    The thread blocks in serial.read() until bytes arrive, so a card id is handled
+    as soon as its line ends. Repeated swipes of the same card within card_debounce
+    seconds count once. A lost port is reopened with exponential backoff.
+    Accepted swipes are delivered as new_card(card_id) and card_event(CardEvent).
+    """
     new_card = pyqtSignal(str)
+    card_event = pyqtSignal(object)
+
+    # reconnect delays grow from BACKOFF_MIN to BACKOFF_MAX seconds
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 10.0
 
-    def __init__(self):
+    def __init__(self, port=None, baudrate=115200):
         super().__init__()
+        self.settings = AppSettings()
         self.message = MessageContainer()
+        self.port = port if port is not None else self.settings.reader_port
+        self.baudrate = baudrate
         self.serial = None
         self.last_id = None
-        self._enable_reading = False
-        self.init_reader()
+        self.last_event = None
+        self.framer = CardFramer()
+        # enable/disable calls are counted: the GUI and each door may want cards at once
+        self._enable_reading = 0
+        self._reading_lock = threading.Lock()
+        self._stop = threading.Event()
 
     def run(self):
-        while True:
-            if self.serial is None:
-                self.message.put(Message("Reader not connected, retrying...", (255, 150, 150), time.time(), 3))
-                print("Please connect reader")
-                self.init_reader()
-                time.sleep(10)
+        backoff = self.BACKOFF_MIN
+        while not self._stop.is_set():
+            if self.serial is None and not self.init_reader():
+                if backoff == self.BACKOFF_MIN:
+                    self.message.put(Message("Reader not connected, retrying...", (255, 150, 150), time.time(), 3))
+                    print("Please connect reader")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.BACKOFF_MAX)
                 continue
+            backoff = self.BACKOFF_MIN
 
             try:
-                data = self.serial.readline()
+                # blocks until at least one byte is there (or the timeout passes), then takes all waiting bytes
+                data = self.serial.read(max(1, self.serial.in_waiting))
                 if not data:
-                    continue  # no data received in timeout period
-                data = data.decode("utf-8").strip()
-                print(f"Received from reader: {data}")
-                if self._enable_reading:
-                    self.last_id = data
-                    self.new_card.emit(data)
-            except serial.SerialException as e:
+                    continue
+                now = time.time()
+                for card_id in self.framer.feed(data):
+                    self.handle_card(card_id, now)
+            except (serial.SerialException, OSError) as e:
+                # a hung-up device fails in_waiting with a plain OSError (EIO) rather than a SerialException
                 self.message.put(Message(f"Serial error: {e}", (255, 150, 150), time.time(), 5))
                 print(f"Serial error, resetting reader: {e}")
-                self.serial = None
+                self.close()
+                self._stop.wait(self.BACKOFF_MIN)
             except Exception as e:
                 print(f"Unexpected error: {e}")
-            time.sleep(0.1)
+                self._stop.wait(self.BACKOFF_MIN)
+        self.close()
+
+    def handle_card(self, card_id, timestamp):
+        print(f"Received from reader: {card_id}")
+        if not self._enable_reading:
+            # nobody waits for a card; a swipe made now must not swallow the next one by debouncing
+            self.last_event = None
+            return
+        last = self.last_event
+        if last is not None and last.card_id == card_id and timestamp - last.timestamp < self.settings.card_debounce:
+            # still the same swipe; keep extending the window while the card stays on the reader
+            self.last_event = last._replace(timestamp=timestamp)
+            return
+        event = CardEvent(card_id, timestamp, self.serial.port if self.serial is not None else None)
+        self.last_event = event
+        self.last_id = card_id
+        self.new_card.emit(card_id)
+        self.card_event.emit(event)
 
     def get_last_id(self):
         return self.last_id
 
     def enable_reading(self):
-        self._enable_reading = True
+        with self._reading_lock:
+            self._enable_reading += 1
 
     def disable_reading(self):
-        self._enable_reading = False
-        self.last_id = None
+        with self._reading_lock:
+            self._enable_reading = max(0, self._enable_reading - 1)
+            self.last_id = None
 
-    def init_reader(self):
-        ports = list_ports.comports()
-        portnames = [p.device for p in ports]  # p.device — правильное имя порта
-        print("Available ports:", portnames)
+    def stop(self):
+        self._stop.set()
+        self.wait(2000)
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception:
+                pass
+        self.serial = None
+        self.framer.reset()
 
+    def candidate_ports(self):
+        """Serial devices to try: the configured port, else ports matching reader_port_match, best match first."""
+        if self.port:
+            return [self.port]
+        ports = list_ports.comports()
         for p in ports:
             print(f"Port: {p.device}, Description: {p.description}, HWID: {p.hwid}")
 
-        try:
-            if portnames:
-                # Попытка открыть последний порт, можно расширить логику выбора
-                print(f"Trying to open port {portnames[-1]}")
-                self.serial = serial.Serial(port=portnames[-1], baudrate=115200, timeout=0.1)
-                self.message.put(Message(f"Reader connected on {portnames[-1]}", (150, 255, 150), time.time(), 3))
-        except serial.SerialException as e:
-            self.message.put(Message(f"Cannot initialize reader: {e}", (255, 100, 100), time.time(), 5))
-            print(f"Cannot initialize reader: {e}")
\ No newline at end of file
+        patterns = self.settings.reader_port_match
+        if not patterns:
+            return [p.device for p in ports]
+        ranked = []
+        for p in ports:
+            text = f"{p.device} {p.description} {p.hwid}"
+            matches = [i for i, pattern in enumerate(patterns) if pattern in text]
+            if matches:
+                ranked.append((matches[0], p.device))
+        # unmatched ports (e.g. a serial console) are never opened
+        return [device for _, device in sorted(ranked)]
+
+    def init_reader(self):
+        """Open the first candidate port that works; returns whether the reader is connected."""
+        portnames = self.candidate_ports()
+        print("Available ports:", portnames)
+        for port in portnames:
+            try:
+                print(f"Trying to open port {port}")
+                self.serial = serial.Serial(port=port, baudrate=self.baudrate, timeout=0.5)
+                self.framer.reset()
+                self.message.put(Message(f"Reader connected on {port}", (150, 255, 150), time.time(), 3))
+                return True
+            except (serial.SerialException, OSError) as e:
+                self.message.put(Message(f"Cannot initialize reader: {e}", (255, 100, 100), time.time(), 5))
+                print(f"Cannot initialize reader: {e}")
+        return False
@@ -1,9 +1,30 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+import cv2
 import torch
 import numpy as np
-from facenet_pytorch import MTCNN, InceptionResnetV1
-from PyQt5.QtCore import QObject, pyqtSignal
+from facenet_pytorch import MTCNN
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from settings import AppSettings
 from database import Person
+from frames import Frame
+from gallery import create_index, load_index
+import metrics
+from metrics import Histogram
+from backends import load_embedder, build_mtcnn
+import startup
+
+# Tag stored next to every embedding; bump it whenever the detector settings or
+# the embedding network change so old vectors get re-encoded.
+MODEL_TAG = "InceptionResnetV1-vggface2/mtcnn-160-m20/v1"
+
+
+STAGE_TIME = {
+    stage: metrics.registry.histogram("faceauth_recognizer_stage_seconds", "Time per recognition stage", stage=stage)
+    for stage in ("align", "embed", "match", "lookup")
+}
 
 
 class FaceDetector(QObject):
@@ -21,17 +42,66 @@ class FaceDetector(QObject):
             return
         super().__init__()
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.mtcnn = MTCNN(image_size=160, margin=20, device=self.device, keep_all=True)
         self.settings = AppSettings()
+        self.mtcnn = build_mtcnn(self.settings.detector_backend,
+                                 MTCNN(image_size=160, margin=20, device=self.device, keep_all=True),
+                                 threads=self.settings.torch_threads)
+        self.configure_detection(self.settings.detect_scale, self.settings.expected_face_size)
         self._initialized = True
 
+    def configure_detection(self, scale, expected_face_size):
+        """Set up the camera-frame detector for a downscale factor and the face size expected at the door.
+
+        The image pyramid starts at faces half the expected size (in full-resolution pixels),
+        which skips the large, costly pyramid levels that only find tiny faces.
+        """
+        self.detect_scale = scale
+        min_face_size = max(12, int(expected_face_size * 0.5 * scale))
+        self.frame_mtcnn = MTCNN(image_size=160, margin=20, min_face_size=min_face_size,
+                                 device=self.device, keep_all=True)
+        # the stages are shared with self.mtcnn, so the backend is built only once
+        self.frame_mtcnn.pnet, self.frame_mtcnn.rnet, self.frame_mtcnn.onet = self.mtcnn.pnet, self.mtcnn.rnet, self.mtcnn.onet
+
     def detect_faces(self, image):
         return self.mtcnn.detect(image)
 
+    def detect_photo(self, image):
+        """Detect faces of a photo at full resolution, without the camera's downscale and face-size limits."""
+        boxes, probs, landmarks = self.mtcnn.detect(image, landmarks=True)
+        if boxes is None:
+            return Frame(np.asarray(image))
+        return Frame(np.asarray(image), boxes, probs, landmarks)
+
+    def detect(self, image):
+        """Run the detector once and return a Frame carrying boxes, probabilities and landmarks.
+
+        Detection runs on a copy downscaled by detect_scale; boxes and landmarks are mapped
+        back so crops are still taken from the full-resolution image.
+        """
+        small = image
+        if self.detect_scale != 1.0:
+            small = cv2.resize(image, None, fx=self.detect_scale, fy=self.detect_scale, interpolation=cv2.INTER_AREA)
+        boxes, probs, landmarks = self.frame_mtcnn.detect(small, landmarks=True)
+        if boxes is None:
+            return Frame(image)
+        return Frame(image, boxes / self.detect_scale, probs, landmarks / self.detect_scale)
+
+    def extract(self, frame, indices=None):
+        """Crop and standardize faces of an already detected Frame, without detecting again."""
+        boxes = frame.boxes if indices is None else frame.boxes[indices]
+        if len(boxes) == 0:
+            return None
+        return self.mtcnn.extract(frame.image, boxes, None)
+
     def align_single(self, image):
+        if isinstance(image, Frame):
+            faces = self.extract(image, [0])
+            return None if faces is None else faces[0]
         return self.mtcnn(image)[0]
 
     def align_multiple(self, image):
+        if isinstance(image, Frame):
+            return self.extract(image)
         return self.mtcnn(image)
 
     def align_to_np(self, image):
@@ -41,6 +111,78 @@ class FaceDetector(QObject):
         return ((tensor.permute(1, 2, 0).cpu().numpy() * 128) + 127.5).astype(np.uint8).copy()
 
 
+class EmbeddingService:
+    """Single owner of the embedding network, shared by streams, tracks and enrollment.
+
+    Requests are collected into one forward pass until either max_batch_size crops are
+    pending or the oldest request has waited max_wait_ms. A request is never split, so a
+    single request larger than max_batch_size runs on its own.
+    """
+    def __init__(self, model, device, max_batch_size=16, max_wait_ms=5.0):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.queue_wait_ms = Histogram([0.5, 1, 2, 5, 10, 20, 50, 100, 250])
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="EmbeddingService", daemon=True)
+        self._thread.start()
+
+    def submit(self, crops):
+        """Queue an N x 3 x 160 x 160 tensor; the Future resolves to an N x 512 CPU tensor."""
+        future = Future()
+        with self._cond:
+            self._pending.append((crops, future, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def embed(self, crops):
+        return self.submit(crops).result()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        return {"batch_size": self.batch_sizes.snapshot(), "queue_wait_ms": self.queue_wait_ms.snapshot()}
+
+    def _next_batch(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending)
+            deadline = self._pending[0][2] + self.max_wait
+            while sum(len(c) for c, _, _ in self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0][0]) <= self.max_batch_size):
+                batch.append(self._pending.pop(0))
+                size += len(batch[-1][0])
+            return batch, size
+
+    def _run(self):
+        while True:
+            batch, size = self._next_batch()
+            now = time.perf_counter()
+            for _, _, submitted in batch:
+                self.queue_wait_ms.observe((now - submitted) * 1000)
+            self.batch_sizes.observe(size)
+            try:
+                with torch.no_grad():
+                    out = self.model(torch.cat([crops for crops, _, _ in batch]).to(self.device)).cpu()
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for crops, future, _ in batch:
+                future.set_result(out[start:start + len(crops)])
+                start += len(crops)
+
+
 class InceptionResnetV1Recognizer(QObject):
     """Recognizer class that uses face embeddings to identify persons."""
     def __init__(self, database):
@@ -48,48 +190,188 @@ class InceptionResnetV1Recognizer(QObject):
         self.database = database
         self.settings = AppSettings()
 
+        if self.settings.torch_threads > 0:
+            torch.set_num_threads(self.settings.torch_threads)
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.resnet = InceptionResnetV1(pretrained='vggface2').eval().to(self.device)
+        self.resnet = load_embedder(self.settings.backend, self.device, self.settings.threshold,
+                                    threads=self.settings.torch_threads)
+        self.embedder = EmbeddingService(self.resnet, self.device,
+                                         self.settings.embed_max_batch, self.settings.embed_max_wait_ms)
+        metrics.registry.register("faceauth_embed_batch_size", "histogram", "Crops per embedding forward pass",
+                                  self.embedder.batch_sizes)
+        metrics.registry.register("faceauth_embed_queue_wait_milliseconds", "histogram",
+                                  "Time embedding requests waited for their batch", self.embedder.queue_wait_ms)
+        metrics.registry.register("faceauth_embed_queue_depth", "gauge", "Embedding requests waiting for a batch",
+                                  self.embedder.queue_depth)
         self.detector = FaceDetector()
+        startup.mark("models loaded")
 
-        self.db_encodings = {}
-        self.database.databaseChanged.connect(self.initialize_encodings)
+        # <db>.gallery.<generation>.npy holds the embedding matrix, <db>.gallery.npz the id map,
+        # index metadata and the name of its matrix file
+        self.index_path = os.path.splitext(self.database.db_path)[0] + ".gallery"
+        self.index = create_index(self.settings.index_type, nprobe=self.settings.index_nprobe)
+        self.database.personAdded.connect(self.add_encoding)
+        self.database.personRemoved.connect(self.remove_encoding)
         self.initialize_encodings()
+        startup.mark("gallery loaded")
+
+    def warm_up(self):
+        """Run the detector and the embedder once so the first real frame doesn't pay for lazy init."""
+        self.detector.detect(np.zeros((480, 270, 3), np.uint8))
+        self._encode(torch.zeros(1, 3, 160, 160))
 
     def initialize_encodings(self):
-        """Load and encode all persons from the database."""
-        self.db_encodings.clear()
-        for person in self.database.get_all():
-            encoding = self._get_encoding(person.img)
-            if encoding is not None:
-                self.db_encodings[person.id] = encoding
-        print(f"[Recognizer] Encoded {len(self.db_encodings)} faces.")
+        """Load the saved index (or stored embeddings) and encode persons that have none yet."""
+        backfill, no_face = {}, []
+        # full batches go to the embedder while the next photos are being aligned
+        chunks, ids, crops = [], [], []
+        for person in self.database.get_unencoded(MODEL_TAG):
+            try:
+                crop = self.detector.align_single(person.img)
+            except Exception as e:
+                print(f"[Recognizer ERROR] Failed to align person {person.id}: {e}")
+                crop = None
+            if crop is None:
+                no_face.append(person.id)
+                continue
+            ids.append(person.id)
+            crops.append(crop)
+            if len(crops) == self.embedder.max_batch_size:
+                chunks.append((ids, self.embedder.submit(torch.stack(crops))))
+                ids, crops = [], []
+        if crops:
+            chunks.append((ids, self.embedder.submit(torch.stack(crops))))
+        for chunk_ids, future in chunks:
+            backfill.update(zip(chunk_ids, future.result().numpy()))
+        if backfill:
+            self.database.set_embeddings(backfill, MODEL_TAG)
+        if no_face:
+            # tried once per model version, not on every start
+            print(f"[Recognizer] No face found for persons {no_face}")
+            self.database.mark_no_face(no_face, MODEL_TAG)
+
+        kind, nprobe = self.settings.index_type, self.settings.index_nprobe
+        index = load_index(self.index_path, kind, MODEL_TAG, nprobe=nprobe, dtype=self.settings.gallery_dtype)
+        if index is None:
+            index = create_index(kind, nprobe=nprobe)
+            index.load(self.database.get_embeddings(MODEL_TAG))
+        else:
+            # The saved index may predate the last adds/removes; patch only the difference.
+            stored = set(self.database.get_embedding_ids(MODEL_TAG))
+            indexed = set(index.ids.tolist())
+            for id in indexed - stored:
+                index.remove(id)
+            for id in stored - indexed:
+                index.add(id, self.database.get_embedding(id, MODEL_TAG))
+        if getattr(index, "needs_training", lambda: False)():
+            index.train()
+        self.index = index
+        self.save_index()
+        print(f"[Recognizer] Loaded {len(self.index)} faces.")
+
+    def save_index(self):
+        """Write the gallery files, unless nothing changed since they were loaded or last saved."""
+        if not self.index.dirty:
+            return
+        try:
+            self.index.save(self.index_path, MODEL_TAG, self.settings.gallery_dtype)
+        except Exception as e:
+            print(f"[Recognizer ERROR] Failed to save index: {e}")
+
+    def encode_person(self, person):
+        """Compute the embedding of a person's photo and tag it with the model version."""
+        encoding = self._get_encoding(person.img)
+        if encoding is None:
+            return None
+        person.embedding = encoding.numpy()
+        person.embedding_model = MODEL_TAG
+        return person.embedding
+
+    @pyqtSlot(int)
+    def add_encoding(self, id):
+        """Patch the gallery with a newly added person."""
+        embedding = self.database.get_embedding(id, MODEL_TAG)
+        if embedding is None:
+            person = self.database.get_person_by_id(id)
+            embedding = self.encode_person(person) if person.img is not None else None
+            if embedding is None:
+                print(f"[Recognizer] No face found for person {id}")
+                self.database.mark_no_face([id], MODEL_TAG)
+                return
+            self.database.set_embedding(id, embedding, MODEL_TAG)
+        self.index.add(id, embedding)
+
+    @pyqtSlot(int)
+    def remove_encoding(self, id):
+        self.index.remove(id)
 
     def recognize_single(self, image):
-        """Recognize the most likely person in an image."""
+        """Recognize the most likely person in an image or a detected Frame."""
         encoding = self._get_encoding(image)
         if encoding is None:
             return Person()
         return self._match_encoding(encoding)
 
     def recognize_all(self, image):
-        """Recognize all detected faces in an image."""
+        """Recognize all faces in an image or a detected Frame."""
         encodings = self._get_encodings(image)
-        if encodings is None or len(self.db_encodings) == 0:
+        if encodings is None or len(self.index) == 0:
             return [Person()]
-        return [self._match_encoding(e) for e in encodings]
+        return self._match_encodings(encodings)
+
+    def identify(self, frame, indices=None):
+        """Recognize the faces of a detected Frame; returns a (Person, distance) pair per face."""
+        t = metrics.now()
+        try:
+            if frame.embeddings is not None:
+                encodings = frame.embeddings if indices is None else frame.embeddings[indices]
+                missing = np.flatnonzero(~np.isfinite(encodings).all(axis=1))
+                if len(missing):
+                    # rows the inference workers left empty (e.g. faces that failed their quality checks)
+                    rows = np.arange(len(frame)) if indices is None else np.asarray(indices)
+                    encodings = np.array(encodings, np.float32)
+                    encodings[missing] = np.asarray(self._encode(self.detector.extract(frame, rows[missing])))
+            else:
+                crops = self.detector.extract(frame, indices)
+                if crops is None:
+                    return []
+                t = metrics.lap(STAGE_TIME["align"], t)
+                encodings = self._encode(crops)
+                t = metrics.lap(STAGE_TIME["embed"], t)
+        except Exception as e:
+            print(f"[Recognizer ERROR] Failed to identify faces: {e}")
+            return []
+        ids, distances = self.match(encodings)
+        t = metrics.lap(STAGE_TIME["match"], t)
+        persons = [(self._person_for(id, dist), float(dist)) for id, dist in zip(ids[:, 0], distances[:, 0])]
+        metrics.lap(STAGE_TIME["lookup"], t)
+        return persons
+
+    def match(self, encodings, k=1):
+        """Return (ids, distances) of the k nearest gallery entries for each encoding."""
+        return self.index.match(np.asarray(encodings, np.float32), k)
 
     def _match_encoding(self, encoding):
         """Find the best match for a single encoding."""
-        if not self.db_encodings:
-            return Person()
-        
-        distances = {pid: torch.norm(encoding - enc).item() for pid, enc in self.db_encodings.items()}
-        best_id, best_dist = min(distances.items(), key=lambda item: item[1])
+        return self._match_encodings(encoding.reshape(1, -1))[0]
 
-        if best_dist > self.settings.threshold:
+    def _match_encodings(self, encodings):
+        """Find the best match for every encoding in one batched search."""
+        ids, distances = self.match(encodings)
+        return [self._person_for(best_id, best_dist) for best_id, best_dist in zip(ids[:, 0], distances[:, 0])]
+
+    def _person_for(self, best_id, best_dist):
+        if best_id < 0 or not np.isfinite(best_dist) or best_dist > self.settings.threshold:
             return Person()
-        return self.database.get_person_by_id(best_id)
+        return self.database.get_person_by_id(int(best_id))
+
+    def embed_face(self, image):
+        """Embedding of the largest face in an image or a detected Frame, or None if there is none."""
+        encoding = self._get_encoding(image)
+        return None if encoding is None else encoding.numpy()
+
+    def _encode(self, crops):
+        return self.embedder.embed(crops)
 
     def _get_encodings(self, image):
         """Align and encode all faces in image."""
@@ -97,7 +379,7 @@ class InceptionResnetV1Recognizer(QObject):
             cropped_imgs = self.detector.align_multiple(image)
             if cropped_imgs is None:
                 return None
-            return self.resnet(cropped_imgs.to(self.device)).cpu()
+            return self._encode(cropped_imgs)
         except Exception as e:
             print(f"[Recognizer ERROR] Failed to get encodings: {e}")
             return None
@@ -108,7 +390,7 @@ class InceptionResnetV1Recognizer(QObject):
             cropped = self.detector.align_single(image)
             if cropped is None:
                 return None
-            return self.resnet(cropped.unsqueeze(0).to(self.device)).cpu()[0]
+            return self._encode(cropped.unsqueeze(0))[0]
         except Exception as e:
             print(f"[Recognizer ERROR] Failed to get encoding: {e}")
             return None
\ No newline at end of file
@@ -0,0 +1,237 @@
+"""
+service.py – headless recognition service
+
+Runs the recognizer and the person database without the Qt window and answers
+other doors and kiosks over HTTP on localhost:
+
+    POST /identify                      photo -> every face with its best match (never its card id)
+    POST /verify?card=<cardId>          photo -> does the largest face belong to the card holder
+    POST /enroll?card=<cardId>&name=..  photo -> adds a person
+    GET  /health, GET /metrics
+
+Photos are sent as the raw JPEG/PNG request body. Requests run on a bounded
+worker pool. Faces embedded by concurrent requests are batched by the
+recognizer's EmbeddingService. Once workers + queue requests are in flight,
+new ones are refused at once with 503 and Retry-After instead of piling up.
+
+    python app/service.py --port 8080 --workers 4 --queue 16
+"""
+import argparse
+import io
+import json
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from PIL import Image
+from PyQt5.QtCore import QCoreApplication, QTimer
+import startup
+import metrics
+
+MAX_BODY = 10 * 1024 * 1024
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RecognitionService:
+    """The API operations, run on a bounded pool in front of one shared recognizer."""
+    def __init__(self, db, recognizer, workers=4, queue=16, timeout=10.0):
+        self.db = db
+        self.recognizer = recognizer
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="ServiceWorker")
+        # admission control: at most `workers` running and `queue` waiting, everything else is refused
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.request_time = {}
+        self.responses = {}
+
+    def call(self, operation, *args):
+        """Run an operation on the pool; raises ServiceError(503) when full and (504) when it takes too long."""
+        if not self.slots.acquire(blocking=False):
+            raise ServiceError(503, "overloaded, retry later")
+        t = metrics.now()
+        future = self.pool.submit(self._run, operation, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # the slot is given back when the operation really finishes
+            raise ServiceError(504, "timed out")
+        finally:
+            self._histogram(operation.__name__).observe_since(t)
+
+    def _run(self, operation, *args):
+        try:
+            return operation(*args)
+        finally:
+            self.slots.release()
+
+    def _histogram(self, name):
+        if name not in self.request_time:
+            self.request_time[name] = metrics.registry.histogram(
+                "faceauth_service_request_seconds", "Service request time including queueing", operation=name)
+        return self.request_time[name]
+
+    def count(self, operation, status):
+        key = (operation, status)
+        if key not in self.responses:
+            self.responses[key] = metrics.registry.counter(
+                "faceauth_service_responses_total", "Service responses by operation and status",
+                operation=operation, status=str(status))
+        self.responses[key].inc()
+
+    def identify(self, image):
+        frame = self.recognizer.detector.detect_photo(image)
+        if not frame.has_faces:
+            return {"faces": []}
+        faces = []
+        for box, (person, distance) in zip(frame.boxes, self.recognizer.identify(frame)):
+            faces.append({"box": [round(float(v), 1) for v in box], "recognized": person.id != -1,
+                          "id": person.id, "name": person.name, "distance": distance})
+        return {"faces": faces}
+
+    def verify(self, image, card_id):
+        from recognizer import MODEL_TAG
+        person = self.db.get_person_by_cardid(card_id)
+        if person.id == -1:
+            raise ServiceError(404, f"card {card_id} is not enrolled")
+        stored = self.db.get_embedding(person.id, MODEL_TAG)
+        if stored is None:
+            raise ServiceError(409, f"card {card_id} has no embedding for the current model")
+        embedding = self.recognizer.embed_face(self.recognizer.detector.detect_photo(image))
+        if embedding is None:
+            raise ServiceError(422, "no face found")
+        distance = float(np.linalg.norm(embedding - stored))
+        return {"card": card_id, "name": person.name, "match": distance <= self.recognizer.settings.threshold,
+                "distance": distance}
+
+    def enroll(self, image, card_id, name):
+        from database import Person
+        if not card_id or not name:
+            raise ServiceError(400, "card and name are required")
+        if self.db.get_person_by_cardid(card_id).id != -1:
+            raise ServiceError(409, f"card {card_id} is already enrolled")
+        person = Person(cardId=card_id, name=name, img=image)
+        if self.recognizer.encode_person(person) is None:
+            raise ServiceError(422, "no face found")
+        if not self.db.add_persons([person]):
+            # the unique cardId index rejects a concurrent enrollment of the same card
+            if self.db.get_person_by_cardid(card_id).id != -1:
+                raise ServiceError(409, f"card {card_id} is already enrolled")
+            raise ServiceError(500, "database error")
+        return {"id": person.id, "card": card_id, "name": name}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == "/health":
+                self.reply(200, {"status": "ok", "faces": len(service.recognizer.index)})
+            elif path == "/metrics":
+                self.reply(200, metrics.registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+            else:
+                self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            operation = url.path.strip("/")
+            try:
+                if operation not in ("identify", "verify", "enroll"):
+                    raise ServiceError(404, "not found")
+                image = self.read_image()
+                if operation == "identify":
+                    result = service.call(service.identify, image)
+                elif operation == "verify":
+                    result = service.call(service.verify, image, query.get("card", ""))
+                else:
+                    result = service.call(service.enroll, image, query.get("card", ""), query.get("name", ""))
+                self.reply(200, result)
+                service.count(operation, 200)
+            except ServiceError as e:
+                self.reply(e.status, {"error": str(e)}, retry_after=e.status == 503)
+                service.count(operation, e.status)
+            except Exception as e:
+                print(f"[Service ERROR] {operation} failed: {e}")
+                self.reply(500, {"error": "internal error"})
+                service.count(operation, 500)
+
+        def read_image(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0:
+                raise ServiceError(400, "photo expected as request body")
+            if length > MAX_BODY:
+                raise ServiceError(413, "photo too large")
+            body = self.rfile.read(length)
+            try:
+                return Image.open(io.BytesIO(body)).convert("RGB")
+            except Exception:
+                raise ServiceError(400, "body is not a readable image")
+
+        def reply(self, status, body, content_type="application/json", retry_after=False):
+            data = body.encode() if isinstance(body, str) else json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            if retry_after:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # one line per request would drown the console under load
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="persons.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4, help="requests processed at once")
+    parser.add_argument("--queue", type=int, default=16, help="requests allowed to wait for a worker")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds before a request gets 504")
+    args = parser.parse_args()
+
+    # the Qt event loop delivers the database signals that keep the gallery in sync
+    app = QCoreApplication(sys.argv)
+    from database import SQLiteDatabase
+    from recognizer import InceptionResnetV1Recognizer
+    db = SQLiteDatabase(args.db)
+    recognizer = InceptionResnetV1Recognizer(db)
+    recognizer.warm_up()
+    app.aboutToQuit.connect(recognizer.save_index)
+    metrics.enabled = True
+
+    service = RecognitionService(db, recognizer, args.workers, args.queue, args.timeout)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ServiceHTTP", daemon=True).start()
+    startup.mark("service ready")
+    print(f"[Service] Listening on http://{args.host}:{args.port} "
+          f"({args.workers} workers, {args.queue} queued requests at most)")
+
+    signal.signal(signal.SIGINT, lambda *_: app.quit())
+    signal.signal(signal.SIGTERM, lambda *_: app.quit())
+    # lets the Python signal handlers run while Qt's loop is waiting
+    heartbeat = QTimer()
+    heartbeat.timeout.connect(lambda: None)
+    heartbeat.start(200)
+    code = app.exec()
+    server.shutdown()
+    service.pool.shutdown(wait=True)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,13 +9,66 @@ class AppSettings(QObject):
     def __init__(self):
         super().__init__()
         self.possible_modes = ["single", "multiple"]
+        self.possible_index_types = ["exact", "ivf"]
+        self.possible_gallery_dtypes = ["float32", "float16"]
+        self.possible_backends = ["eager", "torchscript", "int8", "onnx"]
         self.filename = os.path.join("config", "settings.json")
 
         # Значения по умолчанию
         self.threshold = 0.8
+        # "exact" scans the whole gallery, "ivf" scans index_nprobe clusters:
+        # more probes give better recall at the cost of latency
+        self.index_type = "exact"
+        self.index_nprobe = 8
+        # precision of the memory-mapped gallery file: "float16" halves its size and page-cache
+        # footprint, but every search then converts the matrix to float32 on the fly
+        self.gallery_dtype = "float32"
         self.mode = "multiple"
         self.open_time = 10.0
         self.wait_time = 10
+        # seconds before a tracked face's cached identity is embedded again
+        self.reverify_interval = 2.0
+        # detection gating: mean gray-level change since the last detection that counts as motion,
+        # detect every Nth frame while faces are tracked, full-rate frames after a new face,
+        # and every Nth frame without faces or motion (0 = only on motion)
+        self.motion_threshold = 3.0
+        self.detect_interval = 5
+        self.detect_burst_frames = 10
+        self.idle_detect_interval = 30
+        # MTCNN runs on the camera frame scaled by detect_scale; expected_face_size is the
+        # typical face width in camera pixels at the door and sets the smallest face searched for
+        self.detect_scale = 0.5
+        self.expected_face_size = 100
+        # faces failing any of these are not embedded but wait for a better frame of their track:
+        # smallest box side in camera pixels, MTCNN probability, Laplacian variance of the 64x64
+        # grayscale crop, and landmark yaw/pitch (0 = frontal); 0 disables a check. A camera entry
+        # may carry its own "face_quality" with the keys to override for that door
+        self.face_quality = {"min_face_size": 40, "min_prob": 0.95, "min_sharpness": 15.0,
+                             "max_yaw": 0.4, "max_pitch": 0.3}
+        # 0 runs detection and embedding in the video/lock threads; N > 0 uses N worker
+        # processes, each limited to torch_threads threads (0 = torch default) and pinned
+        # to inference_cpus when given
+        self.inference_workers = 0
+        self.torch_threads = 0
+        self.inference_cpus = []
+        # inference backend of the embedder and of the MTCNN stages, see backends.py
+        self.backend = "eager"
+        self.detector_backend = "eager"
+        # embedding micro-batches: run when this many crops are queued or the oldest waited this long
+        self.embed_max_batch = 16
+        self.embed_max_wait_ms = 5.0
+        # RFID reader: explicit serial device, or "" to pick the first port whose device,
+        # description or hwid contains one of reader_port_match (in that order of preference);
+        # repeated swipes of the same card within card_debounce seconds count once
+        self.reader_port = ""
+        self.reader_port_match = ["ttyUSB", "ttyACM", "CH340", "CP210"]
+        self.card_debounce = 1.0
+        # port of the Prometheus /metrics endpoint on 127.0.0.1; 0 disables it and the timing hooks
+        self.metrics_port = 0
+        # one entry per door: capture device, capture resolution, column crop and GPIO pin
+        self.cameras = [
+            {"name": "door", "source": 0, "resolution": [640, 480], "crop": [185, 455], "lock_pin": 12}
+        ]
 
         if os.path.isfile(self.filename):
             self.load()
@@ -42,17 +95,75 @@ class AppSettings(QObject):
         with open(self.filename, 'r') as f:
             obj = json.load(f)
             self.threshold = obj.get("recognition_threshold", self.threshold)
+            self.index_type = obj.get("index_type", self.index_type)
+            self.index_nprobe = obj.get("index_nprobe", self.index_nprobe)
+            self.gallery_dtype = obj.get("gallery_dtype", self.gallery_dtype)
             self.mode = obj.get("working_mode", self.mode)
             self.open_time = obj.get("open_time", self.open_time)
             self.wait_time = obj.get("wait_time", self.wait_time)
+            self.reverify_interval = obj.get("reverify_interval", self.reverify_interval)
+            self.motion_threshold = obj.get("motion_threshold", self.motion_threshold)
+            self.detect_interval = obj.get("detect_interval", self.detect_interval)
+            self.detect_burst_frames = obj.get("detect_burst_frames", self.detect_burst_frames)
+            self.idle_detect_interval = obj.get("idle_detect_interval", self.idle_detect_interval)
+            self.detect_scale = obj.get("detect_scale", self.detect_scale)
+            self.expected_face_size = obj.get("expected_face_size", self.expected_face_size)
+            self.face_quality = {**self.face_quality, **obj.get("face_quality", {})}
+            self.inference_workers = obj.get("inference_workers", self.inference_workers)
+            self.torch_threads = obj.get("torch_threads", self.torch_threads)
+            self.inference_cpus = obj.get("inference_cpus", self.inference_cpus)
+            self.backend = obj.get("backend", self.backend)
+            self.detector_backend = obj.get("detector_backend", self.detector_backend)
+            self.embed_max_batch = obj.get("embed_max_batch", self.embed_max_batch)
+            self.embed_max_wait_ms = obj.get("embed_max_wait_ms", self.embed_max_wait_ms)
+            self.reader_port = obj.get("reader_port", self.reader_port)
+            self.reader_port_match = obj.get("reader_port_match", self.reader_port_match)
+            self.card_debounce = obj.get("card_debounce", self.card_debounce)
+            self.metrics_port = obj.get("metrics_port", self.metrics_port)
+            self.cameras = obj.get("cameras", self.cameras)
+        self.validate()
+
+    def validate(self):
+        """Reject choices outside the possible_* lists instead of silently running with a fallback."""
+        for name, value, possible in (("working_mode", self.mode, self.possible_modes),
+                                      ("index_type", self.index_type, self.possible_index_types),
+                                      ("gallery_dtype", self.gallery_dtype, self.possible_gallery_dtypes),
+                                      ("backend", self.backend, self.possible_backends),
+                                      ("detector_backend", self.detector_backend, self.possible_backends)):
+            if value not in possible:
+                raise ValueError(f"{self.filename}: {name} must be one of: " + ", ".join(possible)
+                                 + f" (got {value!r})")
 
     def save(self):
         with open(self.filename, 'w') as f:
             json.dump({
                 "recognition_threshold": self.threshold,
+                "index_type": self.index_type,
+                "index_nprobe": self.index_nprobe,
+                "gallery_dtype": self.gallery_dtype,
                 "working_mode": self.mode,
                 "wait_time": self.wait_time,
-                "open_time": self.open_time
+                "open_time": self.open_time,
+                "reverify_interval": self.reverify_interval,
+                "motion_threshold": self.motion_threshold,
+                "detect_interval": self.detect_interval,
+                "detect_burst_frames": self.detect_burst_frames,
+                "idle_detect_interval": self.idle_detect_interval,
+                "detect_scale": self.detect_scale,
+                "expected_face_size": self.expected_face_size,
+                "face_quality": self.face_quality,
+                "inference_workers": self.inference_workers,
+                "torch_threads": self.torch_threads,
+                "inference_cpus": self.inference_cpus,
+                "backend": self.backend,
+                "detector_backend": self.detector_backend,
+                "embed_max_batch": self.embed_max_batch,
+                "embed_max_wait_ms": self.embed_max_wait_ms,
+                "reader_port": self.reader_port,
+                "reader_port_match": self.reader_port_match,
+                "card_debounce": self.card_debounce,
+                "metrics_port": self.metrics_port,
+                "cameras": self.cameras
             }, f, indent=4)
         print("Settings saved")
         self.settings_changed.emit()
\ No newline at end of file
@@ -0,0 +1,55 @@
+"""
+startup.py – boot-time milestones of FaceTerminal
+
+The first import of this module is taken as process start; mark() records how
+long after that each milestone was reached (only its first occurrence).
+"""
+import time
+import threading
+from PyQt5.QtCore import QThread, QCoreApplication, pyqtSignal
+
+_start = time.perf_counter()
+_marks = {}
+_lock = threading.Lock()
+
+
+def mark(name):
+    with _lock:
+        if name in _marks:
+            return
+        _marks[name] = time.perf_counter() - _start
+    print(f"[Startup] {name}: {_marks[name]:.2f} s")
+    if name == "first recognition":
+        report()
+
+
+def elapsed(name):
+    return _marks.get(name)
+
+
+def report():
+    with _lock:
+        marks = sorted(_marks.items(), key=lambda item: item[1])
+    print("[Startup] Report:")
+    for name, seconds in marks:
+        print(f"[Startup]   {seconds:8.2f} s  {name}")
+    return dict(marks)
+
+
+class ModelLoader(QThread):
+    """Imports torch, loads the models and the gallery, and warms them up off the GUI thread."""
+    loaded = pyqtSignal(object)
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+
+    def run(self):
+        from recognizer import InceptionResnetV1Recognizer
+        mark("torch imported")
+        recognizer = InceptionResnetV1Recognizer(self.database)
+        recognizer.warm_up()
+        mark("warm-up done")
+        # slots of the recognizer (database signals) must run in the GUI thread, not in this one
+        recognizer.moveToThread(QCoreApplication.instance().thread())
+        self.loaded.emit(recognizer)
@@ -4,115 +4,376 @@ import cv2 as cv2
 from PIL import Image
 import numpy as np
 import time
-import queue
-from recognizer import FaceDetector
+import threading
+from collections import OrderedDict
+import startup
+import metrics
+from frames import Frame
+from workers import InferencePool
+from quality import FaceQuality
 from messages import MessageContainer
 from messages import Message
+from settings import AppSettings
+
+class Track():
+    """A face followed across frames together with the identity last recognized for it."""
+    def __init__(self, id, box):
+        self.id = id
+        self.box = box
+        self.misses = 0
+        self.person = None
+        self.distance = float("inf")
+        self.verified_at = 0.0
+
+    @property
+    def name(self):
+        return None if self.person is None else self.person.name
+
+
+class FaceTracker():
+    """Gives detected faces stable ids by greedy IoU association and caches their identities.
+
+    Written by the video thread (update) and read/annotated by the lock thread.
+    """
+    def __init__(self, iou_threshold=0.3, max_misses=5, reverify_interval=2.0, reverify_margin=0.15):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.reverify_interval = reverify_interval
+        self.reverify_margin = reverify_margin
+        self._tracks = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def update(self, frame):
+        """Associate the frame's boxes with existing tracks and store the ids in frame.track_ids."""
+        boxes = frame.boxes
+        with self._lock:
+            tracks = list(self._tracks.values())
+            assigned = [None] * len(boxes)
+            matched = set()
+            if tracks and len(boxes):
+                ious = _iou(np.array([t.box for t in tracks]), boxes)
+                for ti, bi in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                    if ious[ti, bi] < self.iou_threshold:
+                        break
+                    if assigned[bi] is None and ti not in matched:
+                        assigned[bi] = tracks[ti]
+                        matched.add(ti)
+            for ti, track in enumerate(tracks):
+                if ti in matched:
+                    track.misses = 0
+                else:
+                    track.misses += 1
+                    if track.misses > self.max_misses:
+                        del self._tracks[track.id]
+            for bi, box in enumerate(boxes):
+                track = assigned[bi]
+                if track is None:
+                    track = Track(self._next_id, box)
+                    self._tracks[track.id] = track
+                    self._next_id += 1
+                track.box = box
+                assigned[bi] = track.id
+            frame.track_ids = assigned
+        return assigned
+
+    def needs_verification(self, track_id, threshold):
+        """True for unrecognized tracks, stale identities and matches close to the threshold."""
+        with self._lock:
+            track = self._tracks.get(track_id)
+            if track is None or track.person is None:
+                return True
+            age = time.time() - track.verified_at
+            if track.distance > threshold - self.reverify_margin:
+                return age > self.reverify_interval / 4
+            return age > self.reverify_interval
+
+    def set_identity(self, track_id, person, distance):
+        with self._lock:
+            track = self._tracks.get(track_id)
+            if track is not None:
+                track.person = person
+                track.distance = distance
+                track.verified_at = time.time()
+
+    def needs_embedding(self, threshold):
+        """True unless every current track holds a fresh identity."""
+        with self._lock:
+            track_ids = list(self._tracks)
+        return not track_ids or any(self.needs_verification(t, threshold) for t in track_ids)
+
+    def persons(self, track_ids):
+        """Cached identities for the given tracks, None where not recognized yet."""
+        with self._lock:
+            return [self._tracks[t].person if t in self._tracks else None for t in track_ids]
+
+    def names(self, track_ids):
+        return [None if p is None else p.name for p in self.persons(track_ids)]
+
+
+def _iou(a, b):
+    """Pairwise intersection over union of two sets of (x1, y1, x2, y2) boxes."""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class DetectionScheduler():
+    """Decides per frame whether MTCNN has to run.
+
+    With no faces in view a cheap frame-difference gate runs detection on motion,
+    measured against the frame of the last detection so a slow approach adds up,
+    and anyway every `idle_interval` frames (0 = never) so a face that was missed
+    while moving is still found once it stands still. Once faces are tracked,
+    detection runs every `interval` frames, and at full rate for `burst_frames`
+    frames after a new face shows up.
+    """
+    def __init__(self, motion_threshold=3.0, interval=5, burst_frames=10, idle_interval=30, motion_size=(32, 48)):
+        self.motion_threshold = motion_threshold
+        self.interval = interval
+        self.burst_frames = burst_frames
+        self.idle_interval = idle_interval
+        self.motion_size = motion_size
+        self._reference = None
+        self._faces = 0
+        self._burst = 0
+        self._since_detection = 0
+
+    def should_detect(self, frame):
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), self.motion_size, interpolation=cv2.INTER_AREA)
+        self._since_detection += 1
+        if self._burst > 0:
+            self._burst -= 1
+            run = True
+        elif self._faces == 0:
+            run = (self._reference is None or cv2.absdiff(small, self._reference).mean() > self.motion_threshold
+                   or 0 < self.idle_interval <= self._since_detection)
+        else:
+            run = self._since_detection >= self.interval
+        if run:
+            self._reference = small
+        return run
+
+    def detected(self, face_count):
+        """Report the number of faces found by the detection that was just run."""
+        if face_count > self._faces:
+            self._burst = self.burst_frames
+        self._faces = face_count
+        self._since_detection = 0
+
 
 class VideoThread(QThread):
     new_frame_change = pyqtSignal(np.ndarray, np.ndarray)
-    def __init__(self, frame_queue):
+    def __init__(self, frame_buffer, tracker, camera=None, detector=None, pool=None):
         super().__init__()
-        self.queue = frame_queue
-        self.detector = FaceDetector()
-        self.cap = cv2.VideoCapture(0)
+        self.buffer = frame_buffer
+        self.tracker = tracker
+        #frames are shown right away; detection starts once the models are loaded (set_detector)
+        self.detector = detector
+        self.settings = AppSettings()
+        self.scheduler = DetectionScheduler(self.settings.motion_threshold, self.settings.detect_interval,
+                                            self.settings.detect_burst_frames, self.settings.idle_detect_interval)
+        #inference processes shared with the other cameras; started here only if none is given
+        self.pool = pool
+        self.owns_pool = False
+        self.pending = {}
+        self.last_seq = -1
+        self.detected = None
+        self.running = True
+        self.camera = camera if camera is not None else self.settings.cameras[0]
+        self.cap = cv2.VideoCapture(self.camera["source"])
         if not self.cap.isOpened():
-            raise Exception("Could not open video device")
-        #camera resolution
-        self.cwidth = 270
-        self.cheight = 480
+            raise Exception(f"Could not open video device {self.camera['source']}")
+        cam_w, cam_h = self.camera["resolution"]
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, cam_w)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, cam_h)
+        self.crop = self.camera["crop"]
+        #camera resolution after cropping
+        self.cwidth = self.crop[1] - self.crop[0]
+        self.cheight = cam_h
         #display resolution
         self.width = 270
         self.height = 480
         self.renderer = Renderer(self.cwidth,self.cheight,self.width,self.height)
 
+        name = self.camera["name"]
+        self.stage_time = {
+            stage: metrics.registry.histogram("faceauth_video_stage_seconds", "Time per VideoThread stage",
+                                              camera=name, stage=stage)
+            for stage in ("capture", "convert", "resize", "detect", "render")
+        }
+        self.frames_total = metrics.registry.counter("faceauth_frames_total", "Camera frames processed", camera=name)
+        metrics.registry.register("faceauth_frames_dropped_total", "counter",
+                                  "Detected frames replaced before recognition read them",
+                                  lambda: self.buffer.stats()["dropped"], camera=name)
+        metrics.registry.register("faceauth_frame_queue_lag", "gauge",
+                                  "Detected frames published but not read by recognition yet",
+                                  lambda: self.buffer.stats()["lag"], camera=name)
+
     def run(self):
-        process = True
-        faces,_ = None,None
-        while True:
+        while self.running:
             #keep original camera frame for detecting and recognizing
             #and resized for drawing and showing
+            t = metrics.now()
             _ , frame=self.cap.read()
             if not _:
                 continue
-            frame = frame[:,185:455]
+            captured = time.time()
+            t = metrics.lap(self.stage_time["capture"], t)
+            frame = frame[:,self.crop[0]:self.crop[1]]
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            t = metrics.lap(self.stage_time["convert"], t)
 
             image = cv2.resize(frame,(self.width,self.height), interpolation = cv2.INTER_AREA)
+            t = metrics.lap(self.stage_time["resize"], t)
 
-            if process:
-                faces,_ = self.detector.detect_faces(frame)
-            if faces is not None:
-                try:
-                    self.queue.put_nowait(frame)
-                except queue.Full:
-                    self.queue.get_nowait()
-                    self.queue.put_nowait(frame)
-            else:
-                if not self.queue.empty():
-                    self.queue.get_nowait()
+            #frames skipped by the scheduler reuse the last boxes for drawing only
+            process = self.scheduler.should_detect(frame)
+            if self.settings.inference_workers > 0:
+                self.run_workers(frame, process, captured)
+            elif process and self.detector is not None:
+                #detections travel with the frame so recognition doesn't run MTCNN again
+                detected = self.detector.detect(frame)
+                detected.timestamp = captured
+                self.publish(detected)
+            t = metrics.lap(self.stage_time["detect"], t)
+            detected = self.detected
+            faces = detected.boxes if detected is not None and detected.has_faces else None
 
-            self.renderer.render(image, faces)
+            names = self.tracker.names(detected.track_ids) if faces is not None else None
+            self.renderer.render(image, faces, names)
+            metrics.lap(self.stage_time["render"], t)
+            self.frames_total.inc()
             self.new_frame_change.emit(frame,image)
+            startup.mark("first frame")
+
+    def run_workers(self, frame, process, captured):
+        """Hand frames to the inference processes and publish whatever they finished."""
+        name = self.camera["name"]
+        if self.pool is None:
+            self.pool = InferencePool(self.settings.inference_workers, self.settings.torch_threads,
+                                      self.settings.inference_cpus)
+            self.owns_pool = True
+        if not self.pool.registered(name):
+            self.pool.register(name, frame.shape, FaceQuality.from_settings(self.settings, self.camera))
+        if process:
+            seq = self.pool.submit(name, frame, embed=self.tracker.needs_embedding(self.settings.threshold))
+            if seq is not None:
+                self.pending[seq] = (frame, captured)
+        for seq, boxes, probs, landmarks, embeddings in self.pool.poll(name):
+            image, captured = self.pending.pop(seq, (None, None))
+            #workers may finish out of order; never move tracks backwards in time
+            if image is None or boxes is None or seq < self.last_seq:
+                continue
+            self.last_seq = seq
+            self.publish(Frame(image, boxes, probs, landmarks, captured, embeddings=embeddings))
 
+    def publish(self, detected):
+        self.detected = detected
+        self.tracker.update(detected)
+        self.scheduler.detected(len(detected))
+        if detected.has_faces:
+            self.buffer.publish(detected)
+        else:
+            self.buffer.clear()
+
+    def set_detector(self, detector):
+        self.detector = detector
+
+    def stop(self):
+        self.running = False
+        self.wait(2000)
+        if self.owns_pool:
+            self.pool.stop()
 
     def change_size(self, size):
         self.width, self.height = size
-        self.renderer.width, self.renderer.height = size
+        self.renderer.resize(*size)
       
 class Renderer():
+    """Draws face boxes and the message strips over the display-sized frame.
+
+    Message strips are rendered once per (text, color, width) and blended into
+    the frame in place; box scale factors change only in resize().
+    """
+    MESSAGE_HEIGHT = 60
+    SPRITE_CACHE_SIZE = 64
+
     def __init__(self, cw,ch,w,h):
         self.message_queue = MessageContainer()
         self.cwidth = cw
         self.cheight = ch
+        self.sprites = OrderedDict()
+        self.resize(w, h)
+
+    def resize(self, w, h):
         self.width = w
         self.height = h
-    
-    def render(self, image, faces):
+        self.scale = (w / self.cwidth, h / self.cheight)
+        # the text scale of a strip depends on the height too
+        self.sprites.clear()
+
+    def render(self, image, faces, names=None):
         if faces is not None:
-            self.render_boxes(image, faces)
-        for n,m in enumerate(self.message_queue):
-            self.render_message(image,n,m)
-
-    def render_message(self,image, number,message:Message):
-        mes_height=60
-        font = cv2.FONT_HERSHEY_SIMPLEX 
-        color = message.color
+            if names is None:
+                self.render_boxes(image, faces)
+            else:
+                self.render_boxes_with_names(image, faces, names)
+        #strips that don't fit on screen are never drawn, so the cost doesn't grow with the queue
+        visible = (image.shape[0] - 1) // self.MESSAGE_HEIGHT
+        now = time.time()
+        for n,m in enumerate(self.message_queue.snapshot(now)[:visible]):
+            self.render_message(image,n,m,m.alpha(now))
+
+    def render_message(self,image, number,message:Message, alpha):
+        mes_height = self.MESSAGE_HEIGHT
+        sprite = self.sprite(message.text, tuple(message.color), image.shape[1])
+        roi = image[number*mes_height:(number+1)*mes_height]
+        # uint8 blend written straight into the frame rows, no float64 temporaries
+        cv2.addWeighted(sprite, alpha, roi, 1.0 - alpha, 0, dst=roi)
+
+    def sprite(self, text, color, width):
+        """The message strip for text/color at this width, rendered on first use."""
+        key = (text, color, width)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        mes_height = self.MESSAGE_HEIGHT
+        font = cv2.FONT_HERSHEY_SIMPLEX
         font_color = (255,255,255)
-        txt_w,txt_h = cv2.getTextSize(message.text, font, 1, 2)[0]
-        w,h =  self.width,self.height
-        txt_scale = min(w/txt_w,h/txt_h)*0.9
-        painting_rect = np.zeros((mes_height,w,3),dtype = np.uint8)
-        cv2.rectangle(painting_rect,(0,0),(w,mes_height),color,cv2.FILLED)
+        txt_w,txt_h = cv2.getTextSize(text, font, 1, 2)[0]
+        txt_scale = min(width/txt_w,self.height/txt_h)*0.9
+        sprite = np.empty((mes_height,width,3),dtype = np.uint8)
+        sprite[:] = color
         txt_y = int((mes_height+txt_h*txt_scale)/2)
-        txt_x = int((w - txt_w*txt_scale)/2)
-        cv2.putText(painting_rect,message.text, (txt_x, txt_y), font,txt_scale, font_color, 2)
-        if (number+1)*mes_height < image.shape[0]:
-            image[number*mes_height:(number+1)*mes_height,:,:] = image[number*mes_height:(number+1)*mes_height,:,:] * (1-message.transparency) + painting_rect*message.transparency  
+        txt_x = int((width - txt_w*txt_scale)/2)
+        cv2.putText(sprite,text, (txt_x, txt_y), font,txt_scale, font_color, 2)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.SPRITE_CACHE_SIZE:
+            self.sprites.popitem(last=False)
+        return sprite
 
     def render_boxes(self, image, faces, color=(170,170,170)):
         if faces is None:
             return
-        for box in faces:
-            x1, y1, x2, y2 = box
-            w = x2 - x1
-            h = y2 - y1
-            scale_x = self.width / self.cwidth
-            scale_y = self.height / self.cheight
+        scale_x, scale_y = self.scale
+        for x1, y1, x2, y2 in faces:
+            cv2.rectangle(image, (int(x1 * scale_x), int(y1 * scale_y)), (int(x2 * scale_x), int(y2 * scale_y)), color, 2)
 
-            x1 = int(x1 * scale_x)
-            y1 = int(y1 * scale_y)
-            x2 = int(x2 * scale_x)
-            y2 = int(y2 * scale_y)
-
-            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
-
-
-    
     def render_boxes_with_names(self,image,faces,names):
+        scale_x, scale_y = self.scale
         for (x,y,w,h),name in zip(faces,names):
-            x = int(x); y = int(y); w = int(w); h =int(h)
-            color = (130,170,100) if name !="Unknown" else (170,100,130)
+            x = int(x*scale_x); y = int(y*scale_y); w = int(w*scale_x); h =int(h*scale_y)
+            if name is None:
+                color = (170,170,170)
+            else:
+                color = (130,170,100) if name !="Unknown" else (170,100,130)
             font_color = (255, 255, 255)
             cv2.rectangle(image,(x,y),(w,h),color,2)
             border =  int(h*0.1)
@@ -0,0 +1,159 @@
+import os
+import queue
+import threading
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedFrameRing:
+    """Fixed-size frame slots in one shared-memory block.
+
+    The producer copies a frame into a free slot and hands only the slot index to a
+    worker; the worker returns the slot to the free list once it is done reading.
+    """
+    def __init__(self, slots, shape, dtype=np.uint8, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, slot, image):
+        self.frames[slot] = image
+
+    def read(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker_main(tasks, results, free, torch_threads, cpus):
+    """Inference process: detect (and optionally embed) faces of frames from the cameras' rings.
+
+    Rings are attached on a camera's first task. Only faces passing the camera's
+    quality checks are embedded; the rows of the others are NaN.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import torch
+    from recognizer import FaceDetector
+    from backends import load_embedder
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+
+    rings = {}
+    detector = FaceDetector()
+    resnet = load_embedder(detector.settings.backend, detector.device, detector.settings.threshold,
+                           threads=torch_threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        camera, (ring_name, slots, shape), quality, seq, slot, embed = task
+        if camera not in rings:
+            rings[camera] = SharedFrameRing(slots, shape, name=ring_name)
+        embeddings = None
+        try:
+            frame = detector.detect(rings[camera].read(slot))
+            accepted = quality.split(frame)[0] if embed and quality is not None else list(range(len(frame)))
+            if embed and accepted:
+                with torch.no_grad():
+                    crops = detector.extract(frame, accepted)
+                    accepted_embeddings = resnet(crops.to(detector.device)).cpu().numpy()
+                embeddings = np.full((len(frame), accepted_embeddings.shape[1]), np.nan, np.float32)
+                embeddings[accepted] = accepted_embeddings
+            results.put((camera, (seq, frame.boxes, frame.probs, frame.landmarks, embeddings)))
+        except Exception as e:
+            print(f"[Worker ERROR] Inference failed: {e}")
+            results.put((camera, (seq, None, None, None, None)))
+        finally:
+            free.put((camera, slot))
+    for ring in rings.values():
+        ring.close()
+
+
+class InferencePool:
+    """Detection and embedding in worker processes shared by every camera.
+
+    Each camera registers its own SharedFrameRing, since frame sizes differ between
+    cameras, so one set of model copies serves all of them. Free slots and results
+    come back through shared queues and are sorted out per camera here.
+    """
+    def __init__(self, workers, torch_threads=0, cpus=None):
+        self.workers = workers
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.free = ctx.Queue()
+        self._lock = threading.Lock()
+        self._cameras = {}  # camera -> (ring, quality)
+        self._free = {}  # camera -> free slots
+        self._done = {}  # camera -> finished results
+        self._seq = itertools.count()
+        self.processes = [
+            ctx.Process(target=_worker_main, daemon=True,
+                        args=(self.tasks, self.results, self.free, torch_threads, cpus or []))
+            for _ in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def register(self, camera, shape, quality=None, slots=None):
+        """Give a camera its ring of frame slots (2 * workers + 1 unless given) and quality checks."""
+        ring = SharedFrameRing(slots or 2 * self.workers + 1, shape)
+        with self._lock:
+            self._cameras[camera] = (ring, quality)
+            self._free[camera] = list(range(ring.slots))
+            self._done[camera] = []
+
+    def registered(self, camera):
+        return camera in self._cameras
+
+    def submit(self, camera, image, embed=True):
+        """Queue a camera's frame for inference; returns its sequence number, or None if its slots are busy."""
+        with self._lock:
+            self._collect()
+            if not self._free[camera]:
+                return None
+            slot = self._free[camera].pop()
+            seq = next(self._seq)
+        ring, quality = self._cameras[camera]
+        ring.write(slot, image)
+        self.tasks.put((camera, (ring.name, ring.slots, ring.shape), quality, seq, slot, embed))
+        return seq
+
+    def poll(self, camera):
+        """Return the camera's finished (seq, boxes, probs, landmarks, embeddings) without blocking."""
+        with self._lock:
+            self._collect()
+            done, self._done[camera] = self._done[camera], []
+        return done
+
+    def _collect(self):
+        for source, target in ((self.free, self._free), (self.results, self._done)):
+            while True:
+                try:
+                    camera, item = source.get_nowait()
+                except queue.Empty:
+                    break
+                target[camera].append(item)
+
+    def stop(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+        for ring, _ in self._cameras.values():
+            ring.close()
@@ -0,0 +1,10 @@
+"""
+benchmarks – headless measurement scripts for FaceTerminal
+
+Run from the repository root, e.g. ``python -m benchmarks.ann_recall``.
+"""
+import os
+import sys
+
+# The application modules live in app/ and import each other by bare name.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
@@ -0,0 +1,76 @@
+"""
+Recall@k and latency of the IVF index against exact search on a synthetic gallery.
+
+    python -m benchmarks.ann_recall --size 100000 --queries 500
+    python -m benchmarks.ann_recall --nprobe 8 --min-recall 0.95
+
+With --min-recall the exit status is 1 if any of the given nprobe values falls below it.
+"""
+import argparse
+import sys
+import time
+import numpy as np
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+from gallery import EmbeddingGallery, IVFIndex
+
+
+def synthetic_gallery(size, dim=512, seed=0):
+    """Unit-length random vectors, like InceptionResnetV1 embeddings."""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def noisy_queries(vectors, count, noise=0.6, seed=1):
+    """Perturbed copies of gallery entries, i.e. new photos of enrolled people."""
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.choice(len(vectors), count, replace=False)]
+    queries = picked + noise * rng.standard_normal(picked.shape, dtype=np.float32) / np.sqrt(picked.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def timed_match(index, queries, k):
+    start = time.perf_counter()
+    ids = np.concatenate([index.match(q[None], k)[0] for q in queries])
+    return ids, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=1)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--min-recall", type=float, default=None, help="fail if any nprobe has a lower recall@k")
+    args = parser.parse_args()
+
+    vectors = synthetic_gallery(args.size)
+    encodings = dict(zip(range(1, args.size + 1), vectors))
+    queries = noisy_queries(vectors, args.queries)
+
+    exact = EmbeddingGallery()
+    exact.load(encodings)
+    truth, exact_ms = timed_match(exact, queries, args.k)
+
+    ivf = IVFIndex(min_train_size=0)
+    start = time.perf_counter()
+    ivf.load(encodings)
+    print(f"gallery {args.size}, ivf build {time.perf_counter() - start:.1f} s")
+    print(f"{'mode':>10} {'recall@' + str(args.k):>10} {'ms/query':>10}")
+    print(f"{'exact':>10} {1.0:>10.3f} {exact_ms:>10.3f}")
+    failures = 0
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        found, ms = timed_match(ivf, queries, args.k)
+        recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+        low = args.min_recall is not None and recall < args.min_recall
+        failures += low
+        print(f"{'ivf/' + str(nprobe):>10} {recall:>10.3f} {ms:>10.3f}" + ("  BELOW MIN" if low else ""))
+    if args.min_recall is not None:
+        print(f"{failures} nprobe value(s) below recall {args.min_recall}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Parity and throughput of every inference backend against eager PyTorch.
+
+For the embedder it reports the largest cosine distance to eager embeddings of
+synthetic face crops, the limit that distance has at the given match threshold, and
+crops per second at batch 1 and batch 8; for MTCNN, frames per second of a full
+detection pass over a camera-sized frame.
+
+    python -m benchmarks.backends --repeat 20 --threshold 0.8
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+from facenet_pytorch import MTCNN, InceptionResnetV1
+from backends import BACKENDS, build_embedder, build_mtcnn, drift_limit, embedding_drift, face_crops
+
+
+def per_second(fn, repeat):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=0.8, help="recognition_threshold to derive the limit from")
+    parser.add_argument("--threads", type=int, default=0, help="torch/ONNX Runtime threads (0 = default)")
+    parser.add_argument("--frame", default=None, help="image file to run MTCNN on (default: random 480x270)")
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    model = InceptionResnetV1(pretrained='vggface2').eval()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    crops = face_crops(8, seed=1)
+    if args.frame:
+        import cv2
+        frame = cv2.cvtColor(cv2.imread(args.frame), cv2.COLOR_BGR2RGB)
+    else:
+        frame = np.random.default_rng(0).integers(0, 255, (480, 270, 3), dtype=np.uint8)
+
+    eager = build_embedder("eager", model, device, args.threshold)
+    limit = drift_limit(args.threshold)
+    print(f"| {'backend':>11} | {'cos dist':>9} | {'limit':>9} "
+          f"| {'crops/s b1':>10} | {'crops/s b8':>10} | {'MTCNN fps':>9} |")
+    for kind in args.backends:
+        embedder = build_embedder(kind, model, device, args.threshold, threads=args.threads)
+        diff = embedding_drift(eager, embedder, crops)
+        b1 = per_second(lambda: embedder(crops[:1]), args.repeat)
+        b8 = per_second(lambda: embedder(crops), args.repeat) * len(crops)
+        mtcnn = build_mtcnn(kind, MTCNN(image_size=160, margin=20, device=device, keep_all=True), threads=args.threads)
+        fps = per_second(lambda: mtcnn.detect(frame), args.repeat)
+        print(f"| {kind:>11} | {diff:>9.2e} | {limit:>9.2e} | {b1:>10.1f} | {b8:>10.1f} | {fps:>9.1f} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Concurrent reads during enrollment writes against SQLiteDatabase.
+
+One thread enrolls persons (photo + embedding) in batches while reader threads
+fetch photos, card lookups and the embedding table, the way the GUI,
+the lock threads and a recognizer restart do. Reports write throughput, read
+latency percentiles and any errors (e.g. "database is locked").
+
+    python -m benchmarks.db_load --persons 2000 --batch 50 --readers 4
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import numpy as np
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+from database import SQLiteDatabase, Person, encode_image
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return f"p50 {p50:.2f} ms  p95 {p95:.2f} ms  p99 {p99:.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--persons", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=50, help="persons per write transaction")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--photo-size", type=int, default=480, help="side of the square test photo")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "load.db")
+    # a tiny image cache so photo reads really go to SQLite
+    db = SQLiteDatabase(path, image_cache_size=1)
+    rng = np.random.default_rng(0)
+    photo = encode_image(rng.integers(0, 256, (args.photo_size, args.photo_size, 3), np.uint8))
+    done = threading.Event()
+    errors = []
+    reads = {"photo": [], "card": [], "embeddings": []}
+
+    def writer():
+        started = time.perf_counter()
+        try:
+            for start in range(0, args.persons, args.batch):
+                batch = [Person(cardId=f"CARD{i}", name=f"person {i}", img=photo,
+                                embedding=rng.standard_normal(512).astype(np.float32), embedding_model="bench")
+                         for i in range(start, min(start + args.batch, args.persons))]
+                if db.add_persons(batch) != len(batch):
+                    errors.append("write batch failed")
+        finally:
+            done.set()
+        elapsed = time.perf_counter() - started
+        print(f"writes: {args.persons} persons in {elapsed:.2f} s ({args.persons / elapsed:.0f}/s, batch {args.batch})")
+
+    def reader(seed):
+        local = random.Random(seed)
+        while not done.is_set():
+            try:
+                ids = db.get_embedding_ids("bench")
+                if not ids:
+                    continue
+                t = time.perf_counter()
+                db.get_image(local.choice(ids))
+                reads["photo"].append(time.perf_counter() - t)
+                t = time.perf_counter()
+                # cards not in the cache go to SQLite through the cardId index
+                db.get_person_by_cardid(f"MISSING{local.randrange(10 ** 6)}")
+                reads["card"].append(time.perf_counter() - t)
+                if local.random() < 0.02:
+                    t = time.perf_counter()
+                    db.get_embeddings("bench")
+                    reads["embeddings"].append(time.perf_counter() - t)
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for kind, values in reads.items():
+        print(f"{kind:>10} reads: {len(values):6d}  {percentiles(values)}")
+    print(f"errors: {len(errors)}" + (f" (first: {errors[0]})" if errors else ""))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Accuracy/latency of downscaled MTCNN detection on recorded frames.
+
+Every configuration is compared with full-resolution detection using the
+stock MTCNN settings (min_face_size=20). A reference face counts as found
+when a detected box overlaps it with IoU >= 0.5.
+
+    python -m benchmarks.detection_scale recordings/door1/ --scales 1.0 0.75 0.5 0.35
+    python -m benchmarks.detection_scale door1.mp4 --expected-face-size 100
+"""
+import argparse
+import glob
+import os
+import time
+import cv2
+import numpy as np
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+
+
+def read_frames(source, limit=200, crop=(185, 455)):
+    """RGB frames from an image directory or a video file, cropped like VideoThread does."""
+    frames = []
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, "*")))[:limit]:
+            image = cv2.imread(path)
+            if image is not None:
+                frames.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return frames
+    cap = cv2.VideoCapture(source)
+    while len(frames) < limit:
+        ok, image = cap.read()
+        if not ok:
+            break
+        frames.append(cv2.cvtColor(image[:, crop[0]:crop[1]], cv2.COLOR_BGR2RGB))
+    return frames
+
+
+def run(detector, frames):
+    boxes, times = [], []
+    for frame in frames:
+        start = time.perf_counter()
+        boxes.append(detector.detect(frame).boxes)
+        times.append((time.perf_counter() - start) * 1000)
+    return boxes, np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory of frames or a video file")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.35])
+    parser.add_argument("--expected-face-size", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+
+    from PyQt5.QtCore import QCoreApplication
+    from recognizer import FaceDetector
+    from video import _iou
+    app = QCoreApplication([])  # noqa: F841  (AppSettings is a QObject)
+
+    frames = read_frames(args.source, args.limit)
+    if not frames:
+        raise SystemExit(f"No frames read from {args.source}")
+    detector = FaceDetector()
+    detector.configure_detection(1.0, 40)  # min_face_size 20, i.e. stock MTCNN
+    reference, ref_ms = run(detector, frames)
+    total = sum(len(b) for b in reference)
+
+    print(f"{len(frames)} frames, {total} reference faces")
+    print(f"| {'scale':>5} | {'min face':>8} | {'recall':>6} | {'mean IoU':>8} | {'p50 ms':>7} | {'p95 ms':>7} |")
+    print(f"| {'ref':>5} | {20:>8} | {1.0:>6.3f} | {1.0:>8.3f} | "
+          f"{np.percentile(ref_ms, 50):>7.1f} | {np.percentile(ref_ms, 95):>7.1f} |")
+    for scale in args.scales:
+        detector.configure_detection(scale, args.expected_face_size)
+        found, ms = run(detector, frames)
+        hits, ious = 0, []
+        for ref, got in zip(reference, found):
+            if len(ref) and len(got):
+                best = _iou(ref, got).max(axis=1)
+                hits += int(np.sum(best >= 0.5))
+                ious.extend(best[best >= 0.5])
+        recall = hits / total if total else float("nan")
+        mean_iou = float(np.mean(ious)) if ious else float("nan")
+        min_face = detector.frame_mtcnn.min_face_size
+        print(f"| {scale:>5.2f} | {min_face:>8} | {recall:>6.3f} | {mean_iou:>8.3f} | "
+              f"{np.percentile(ms, 50):>7.1f} | {np.percentile(ms, 95):>7.1f} |")
+
+
+if __name__ == "__main__":
+    main()
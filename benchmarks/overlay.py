@@ -0,0 +1,73 @@
+"""
+Per-frame cost of the overlay renderer against the number of queued messages.
+
+The "legacy" column re-renders and float-blends every strip on every frame, as
+Renderer.render_message did before sprites were cached; "cached" is the current
+Renderer. Only the strips that fit on screen are ever drawn, so the cached cost
+should stay flat once the screen is full.
+
+    python -m benchmarks.overlay --counts 0 1 4 8 32 128 --frames 300
+"""
+import argparse
+import time
+import cv2
+import numpy as np
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+from messages import Message, MessageContainer
+from video import Renderer
+
+
+def legacy_render_message(renderer, image, number, message):
+    mes_height = 60
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    txt_w, txt_h = cv2.getTextSize(message.text, font, 1, 2)[0]
+    w, h = renderer.width, renderer.height
+    txt_scale = min(w / txt_w, h / txt_h) * 0.9
+    painting_rect = np.zeros((mes_height, w, 3), dtype=np.uint8)
+    cv2.rectangle(painting_rect, (0, 0), (w, mes_height), message.color, cv2.FILLED)
+    txt_y = int((mes_height + txt_h * txt_scale) / 2)
+    txt_x = int((w - txt_w * txt_scale) / 2)
+    cv2.putText(painting_rect, message.text, (txt_x, txt_y), font, txt_scale, (255, 255, 255), 2)
+    if (number + 1) * mes_height < image.shape[0]:
+        rows = slice(number * mes_height, (number + 1) * mes_height)
+        image[rows] = image[rows] * (1 - message.transparency) + painting_rect * message.transparency
+
+
+def measure(render, frame, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        render(frame.copy())
+    return (time.perf_counter() - start) / frames * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[0, 1, 4, 8, 32, 128])
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--size", type=int, nargs=2, default=[270, 480], metavar=("W", "H"))
+    args = parser.parse_args()
+
+    width, height = args.size
+    renderer = Renderer(270, 480, width, height)
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), np.uint8)
+    queue = MessageContainer()
+    queue.CAPACITY = max(args.counts)  # let the queue grow past its normal bound for the measurement
+    colors = [(0, 120, 0), (150, 0, 0), (0, 0, 150)]
+
+    def legacy(image):
+        for n, m in enumerate(queue.snapshot()):
+            legacy_render_message(renderer, image, n, m)
+
+    print(f"{'messages':>8} {'legacy ms':>10} {'cached ms':>10}")
+    for count in args.counts:
+        queue.clear()
+        for i in range(count):
+            queue.put(Message(f"Message {i}", colors[i % 3], time.time(), 3600))
+        legacy_ms = measure(legacy, frame, args.frames)
+        cached_ms = measure(lambda image: renderer.render(image, None), frame, args.frames)
+        print(f"{count:>8} {legacy_ms:>10.3f} {cached_ms:>10.3f}")
+    queue.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Card-to-event latency of RC522Reader against a pseudo-terminal standing in for the reader.
+
+The script writes card lines into the master side of a pty and times how long
+the reader thread, opened on the slave side, takes to emit card_event. It also
+checks the behaviour around the timing:
+
+- a repeated swipe inside card_debounce is dropped;
+- a line split over two writes still gives one id;
+- the reader notices the port disappearing and goes back to reconnecting.
+
+Every check runs even if an earlier one fails; the exit status is 1 if any failed.
+
+    python -m benchmarks.reader_latency --swipes 200
+"""
+import argparse
+import os
+import pty
+import queue
+import sys
+import time
+import tty
+import numpy as np
+from PyQt5.QtCore import Qt
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+from reader import RC522Reader
+
+
+def open_pty():
+    master, slave = pty.openpty()
+    # raw mode on the slave, like a USB serial adapter (no echo, no line discipline)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def expect(events, timeout=2.0):
+    try:
+        return events.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--swipes", type=int, default=200)
+    args = parser.parse_args()
+
+    master, slave, port = open_pty()
+    reader = RC522Reader(port=port)
+    reader.settings.card_debounce = 0.2
+    events = queue.Queue()
+    reader.card_event.connect(lambda e: events.put((time.perf_counter(), e)), Qt.DirectConnection)
+    reader.enable_reading()
+    reader.start()
+    time.sleep(0.5)
+
+    failures = []
+
+    def check(name, ok, detail=""):
+        print(f"{name}:", "ok" if ok else f"FAILED {detail}".rstrip())
+        if not ok:
+            failures.append(name)
+
+    latencies, wrong = [], []
+    for i in range(args.swipes):
+        sent = time.perf_counter()
+        os.write(master, f"CARD{i:05d}\r\n".encode())
+        received = expect(events)
+        if received is None or received[1].card_id != f"CARD{i:05d}":
+            wrong.append((i, received and received[1].card_id))
+            continue
+        latencies.append((received[0] - sent) * 1000)
+    if latencies:
+        lat = np.array(latencies)
+        print(f"latency ms over {len(lat)} swipes: p50 {np.percentile(lat, 50):.2f}  "
+              f"p95 {np.percentile(lat, 95):.2f}  p99 {np.percentile(lat, 99):.2f}  max {lat.max():.2f}")
+    check("every swipe received", not wrong, f"({len(wrong)} missing or wrong, first: {wrong[:1]})")
+
+    # let a swipe missed above arrive before the next checks
+    time.sleep(0.3)
+    while not events.empty():
+        events.get()
+
+    os.write(master, b"SAME\n")
+    os.write(master, b"SAME\n")
+    first, second = expect(events), expect(events, timeout=0.1)
+    check("debounce", first is not None and second is None)
+
+    time.sleep(0.3)
+    os.write(master, b"SPL")
+    time.sleep(0.05)
+    os.write(master, b"IT\n")
+    received = expect(events)
+    check("split line", received is not None and received[1].card_id == "SPLIT")
+
+    # unplug: close both ends; the reader sees an error or EOF and starts reconnecting
+    os.close(master)
+    os.close(slave)
+    time.sleep(1.0)
+    check("disconnect noticed", reader.serial is None, "(still open)")
+
+    reader.stop()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Load test of the headless recognition service (app/service.py).
+
+Client threads post the same photo to an endpoint for a fixed time. The report
+gives requests per second, latency percentiles of the answered requests, and
+how many were refused with 503 (overload) or 504 (timeout). Run it with more
+clients than the service has workers + queue to see the backpressure.
+
+    python app/service.py --workers 4 --queue 16 &
+    python -m benchmarks.service_load photo.jpg --clients 32 --duration 20
+    python -m benchmarks.service_load photo.jpg --endpoint verify --card 12345678
+"""
+import argparse
+import collections
+import http.client
+import threading
+import time
+from urllib.parse import urlencode
+import numpy as np
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("photo", help="JPEG/PNG photo sent with every request")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--endpoint", choices=["identify", "verify"], default="identify")
+    parser.add_argument("--card", default="", help="card id for --endpoint verify")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    args = parser.parse_args()
+
+    with open(args.photo, "rb") as f:
+        body = f.read()
+    path = "/" + args.endpoint + ("?" + urlencode({"card": args.card}) if args.endpoint == "verify" else "")
+    latencies, statuses, errors = [], collections.Counter(), []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client():
+        connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request("POST", path, body, {"Content-Type": "application/octet-stream"})
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                with lock:
+                    errors.append(str(e))
+                connection.close()
+                connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[response.status] += 1
+                if response.status == 200:
+                    latencies.append(elapsed)
+            if response.status == 503:
+                # a real client would honour Retry-After; a short pause keeps the test hammering
+                time.sleep(0.01)
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(statuses.values())
+    print(f"{args.clients} clients, {elapsed:.1f} s, {total} responses, {len(errors)} connection errors")
+    print(f"answered: {statuses[200]} ({statuses[200] / elapsed:.1f} req/s)  "
+          f"overloaded (503): {statuses[503]}  timed out (504): {statuses[504]}")
+    other = {status: n for status, n in statuses.items() if status not in (200, 503, 504)}
+    if other:
+        print(f"other statuses: {dict(other)}")
+    if latencies:
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        print(f"latency of answered requests: p50 {p50:.1f} ms  p95 {p95:.1f} ms  p99 {p99:.1f} ms  "
+              f"max {max(latencies) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Stage-by-stage benchmark of the recognition pipeline, with JSON results and regression checks.
+
+Stages:
+
+    detect     FaceDetector.detect_faces and align_multiple on camera-sized frames
+    encode     InceptionResnetV1Recognizer._get_encodings (alignment + embedding)
+    match      _match_encoding against synthetic galleries of the given sizes
+    render     Renderer.render with boxes, names and a full message queue
+    messages   MessageContainer.put and iteration
+    database   SQLiteDatabase batched writes, photo reads and card lookups
+
+Frames are synthetic noise unless --frames points to a directory of images or a
+video, as benchmarks.detection_scale reads them. Every result holds p50/p95/p99
+latencies in ms and the throughput in items per second.
+
+    python -m benchmarks.suite run --out before.json
+    python -m benchmarks.suite run --stages match --gallery-sizes 1000 100000 1000000 --out after.json
+    python -m benchmarks.suite compare before.json after.json --threshold 0.10
+
+compare exits with status 1 if any stage's p50 or p95 got slower by more than
+the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import benchmarks  # noqa: F401  (puts app/ on sys.path)
+
+STAGES = ["detect", "encode", "match", "render", "messages", "database"]
+
+
+def measure(fn, repeat, warmup=3, items=1):
+    """Call fn repeat times after warmup calls; latency percentiles in ms and items per second."""
+    for _ in range(warmup):
+        fn()
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(times * 1000, [50, 95, 99])
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "mean_ms": times.mean() * 1000,
+            "throughput": items / times.mean(), "repeat": repeat, "items": items}
+
+
+def load_frames(args):
+    if args.frames:
+        from benchmarks.detection_scale import read_frames
+        frames = read_frames(args.frames, args.repeat)
+        if frames:
+            return frames
+        raise SystemExit(f"No frames read from {args.frames}")
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (480, 270, 3), np.uint8) for _ in range(8)]
+
+
+def bench_detect(args, context):
+    detector = context["recognizer"].detector
+    frames = load_frames(args)
+    cycle = iter(range(10 ** 9))
+    results = {"detect.detect_faces": measure(lambda: detector.detect_faces(frames[next(cycle) % len(frames)]), args.repeat)}
+    results["detect.align_multiple"] = measure(lambda: detector.align_multiple(frames[next(cycle) % len(frames)]), args.repeat)
+    return results
+
+
+def bench_encode(args, context):
+    import torch
+    recognizer = context["recognizer"]
+    results = {}
+    for batch in args.batch_sizes:
+        crops = torch.randn(batch, 3, 160, 160, generator=torch.Generator().manual_seed(0))
+        results[f"encode.embed[batch={batch}]"] = measure(lambda: recognizer._encode(crops), args.repeat, items=batch)
+    frames = load_frames(args)
+    cycle = iter(range(10 ** 9))
+    results["encode._get_encodings"] = measure(lambda: recognizer._get_encodings(frames[next(cycle) % len(frames)]),
+                                               args.repeat)
+    return results
+
+
+def bench_match(args, context):
+    from benchmarks.ann_recall import synthetic_gallery, noisy_queries
+    from gallery import create_index
+    recognizer = context["recognizer"]
+    saved, results = recognizer.index, {}
+    try:
+        for size in args.gallery_sizes:
+            vectors = synthetic_gallery(size)
+            index = create_index(args.index, nprobe=args.nprobe)
+            index.load(dict(zip(range(1, size + 1), vectors)))
+            recognizer.index = index
+            queries = noisy_queries(vectors, min(size, 256))
+            del vectors
+            cycle = iter(range(10 ** 9))
+            results[f"match._match_encoding[{args.index},n={size}]"] = measure(
+                lambda: recognizer._match_encoding(queries[next(cycle) % len(queries)]), args.repeat)
+            results[f"match._match_encodings[{args.index},n={size},batch=8]"] = measure(
+                lambda: recognizer._match_encodings(queries[:8]), args.repeat, items=8)
+            del index
+    finally:
+        recognizer.index = saved
+    return results
+
+
+def bench_render(args, context):
+    from messages import Message, MessageContainer
+    from video import Renderer
+    queue = MessageContainer()
+    queue.clear()
+    for i in range(queue.CAPACITY):
+        queue.put(Message(f"Benchmark message {i}", (150, 150, 255), time.time(), 3600))
+    renderer = Renderer(270, 480, 270, 480)
+    frame = np.random.default_rng(0).integers(0, 256, (480, 270, 3), np.uint8)
+    boxes = np.array([[20, 40, 120, 160], [140, 60, 240, 190]], np.float32)
+    names = ["Alice", "Unknown"]
+    results = {"render.render": measure(lambda: renderer.render(frame.copy(), boxes, names), args.repeat * 10)}
+    queue.clear()
+    return results
+
+
+def bench_messages(args, context):
+    from messages import Message, MessageContainer
+    queue = MessageContainer()
+    queue.clear()
+    counter = iter(range(10 ** 9))
+    results = {"messages.put": measure(
+        lambda: queue.put(Message(f"m{next(counter) % 64}", (1, 2, 3), time.time(), 3600)), args.repeat * 10)}
+    results["messages.iterate"] = measure(lambda: list(queue), args.repeat * 10)
+    queue.clear()
+    return results
+
+
+def bench_database(args, context):
+    from database import SQLiteDatabase, Person, encode_image
+    db = SQLiteDatabase(os.path.join(context["tmp"], "bench_db.db"), image_cache_size=1)
+    rng = np.random.default_rng(0)
+    photo = encode_image(rng.integers(0, 256, (320, 240, 3), np.uint8))
+    batch, counter = 50, iter(range(10 ** 9))
+
+    def write():
+        db.add_persons([Person(cardId=f"C{next(counter)}", name="bench", img=photo,
+                               embedding=rng.standard_normal(512).astype(np.float32), embedding_model="bench")
+                        for _ in range(batch)])
+
+    results = {f"database.add_persons[batch={batch}]": measure(write, max(10, args.repeat // 10), items=batch)}
+    ids = [p.id for p in db.get_all()]
+    results["database.get_image"] = measure(lambda: db.get_image(ids[next(counter) % len(ids)]), args.repeat)
+    results["database.get_person_by_cardid[miss]"] = measure(
+        lambda: db.get_person_by_cardid(f"missing{next(counter)}"), args.repeat)
+    results["database.get_embeddings"] = measure(lambda: db.get_embeddings("bench"), max(5, args.repeat // 20),
+                                                 items=len(ids))
+    db.close()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(args):
+    from PyQt5.QtCore import QCoreApplication
+    app = QCoreApplication.instance() or QCoreApplication([])  # noqa: F841  (AppSettings is a QObject)
+    context = {"tmp": tempfile.mkdtemp(prefix="faceauth-bench-")}
+    if {"detect", "encode", "match"} & set(args.stages):
+        from database import SQLiteDatabase
+        from recognizer import InceptionResnetV1Recognizer
+        context["recognizer"] = InceptionResnetV1Recognizer(SQLiteDatabase(os.path.join(context["tmp"], "gallery.db")))
+        context["recognizer"].warm_up()
+
+    results = {}
+    for stage in args.stages:
+        print(f"[Bench] {stage} ...", flush=True)
+        results.update(globals()["bench_" + stage](args, context))
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": git_revision(),
+                 "python": platform.python_version(), "machine": platform.machine(),
+                 "cpus": os.cpu_count(), "frames": args.frames or "synthetic"},
+        "results": results,
+    }
+    print_table(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[Bench] Results written to {args.out}")
+
+
+def print_table(results):
+    print(f"{'benchmark':<56} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'items/s':>10}")
+    for name, r in results.items():
+        print(f"{name:<56} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['throughput']:>10.1f}")
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.candidate) as f:
+        candidate = json.load(f)["results"]
+    regressions = 0
+    print(f"{'benchmark':<56} {'p50 old':>9} {'p50 new':>9} {'change':>8} {'p95 change':>10}")
+    for name in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[name], candidate[name]
+        p50, p95 = new["p50_ms"] / old["p50_ms"] - 1, new["p95_ms"] / old["p95_ms"] - 1
+        # small absolute differences are timer noise, not regressions
+        slower = (p50 > args.threshold or p95 > args.threshold) and new["p50_ms"] - old["p50_ms"] > args.min_ms
+        regressions += slower
+        print(f"{name:<56} {old['p50_ms']:>9.3f} {new['p50_ms']:>9.3f} {p50:>+8.1%} {p95:>+10.1%}"
+              + ("  REGRESSION" if slower else ""))
+    for name in sorted(set(baseline) ^ set(candidate)):
+        print(f"{name:<56} only in {'baseline' if name in baseline else 'candidate'}")
+    print(f"[Bench] {regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    run_parser.add_argument("--frames", help="directory of frames or a video file (default: synthetic)")
+    run_parser.add_argument("--repeat", type=int, default=100)
+    run_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16])
+    run_parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    run_parser.add_argument("--index", choices=["exact", "ivf"], default="exact")
+    run_parser.add_argument("--nprobe", type=int, default=8)
+    run_parser.add_argument("--out", help="write the results as JSON")
+    compare_parser = commands.add_parser("compare", help="compare two JSON results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown that counts")
+    compare_parser.add_argument("--min-ms", type=float, default=0.05, help="ignore p50 changes smaller than this")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())